@@ -15,7 +15,7 @@
 
 # Written by John M. Schanck
 
-from Anomos.Protocol import NAT_CHECK_ID, NAME as protocol_name
+from Anomos.Protocol import NAT_CHECK_ID, EXTENSIONS, NAME as protocol_name
 from Anomos import LOG as log
 
 class AnomosNeighborInitializer(object):
@@ -30,6 +30,7 @@ class AnomosNeighborInitializer(object):
         self._message = ''
         self.socket.set_terminator(self._reader.next())
         self.complete = False
+        self.extensions = 0 # Extension flags both neighbors support
         if self.socket.started_locally:
             self.write_header()
     def collect_incoming_data(self, data):
@@ -57,7 +58,8 @@ class AnomosNeighborInitializer(object):
             log.info("Dropping connection from %s:%d - Neighbor ID mismatch." % self.socket.addr)
             return
         self._message = ''
-        yield 7  # reserved bytes (ignore these for now)
+        yield 7  # reserved bytes, the first holds extension flags
+        self.extensions = ord(self._message[0]) & EXTENSIONS
         self._got_full_header()
         self._message = ''
     def _got_full_header(self):
@@ -67,14 +69,15 @@ class AnomosNeighborInitializer(object):
         # Tell the neighbor manager we've got a completed connection
         # so that it can create a NeighborLink
         self.complete = True
-        self.manager.connection_completed(self.socket, self.id)
+        self.manager.connection_completed(self.socket, self.id,
+                                          self.extensions)
         if self.id == NAT_CHECK_ID:
             self.socket.handle_close()
         self.socket = None
     def protocol_extensions(self):
-        """Anomos puts [1:nid][7:null char] into the
+        """Anomos puts [1:nid][1:extension flags][6:null char] into the
            BitTorrent reserved header bytes"""
-        return self.id + '\0\0\0\0\0\0\0'
+        return self.id + chr(EXTENSIONS) + '\0\0\0\0\0\0'
     def write_header(self):
         """Return properly formatted Anomos connection header
            example with id 255:
@@ -7,6 +7,7 @@ from collections import deque
 
 from errno import ECONNRESET, ENOTCONN, ESHUTDOWN
 from Anomos import LOG as log
+from Anomos.Poller import channel_closing
 from M2Crypto import SSL
 
 class Dispatcher (asyncore.dispatcher):
@@ -16,11 +17,22 @@ class Dispatcher (asyncore.dispatcher):
     # these are overridable defaults
 
     ac_in_buffer_size       = 4096
-    ac_out_buffer_size      = 4096
+    ac_in_buffer_min        = 4096
+    ac_in_buffer_max        = 65536
+    # One full TLS record worth of plaintext per write
+    ac_out_buffer_size      = 16384
+    # Sent bytes are only cut from the front of the output buffer once
+    # at least this much has accumulated, keeping compaction amortized O(1)
+    ac_out_compact_size     = 65536
 
     def __init__(self, conn=None):
+        # ac_in_buffer only ever holds a partial string terminator
         self.ac_in_buffer = ''
-        self.ac_out_buffer = ''
+        self.ac_in_buffer_size = self.ac_in_buffer_min
+        # Outgoing data lives in a growable bytearray, with
+        # ac_out_offset marking how much of it has been sent.
+        self.ac_out_buffer = bytearray()
+        self.ac_out_offset = 0
         self.producer_fifo = fifo()
         self.zero_count = 0
         asyncore.dispatcher.__init__ (self, conn)
@@ -45,6 +57,16 @@ class Dispatcher (asyncore.dispatcher):
     def get_terminator (self):
         return self.terminator
 
+    def _adapt_read_size(self, n):
+        """ Grow the read size while reads fill it, shrink it again once
+            the connection goes quiet """
+        if n >= self.ac_in_buffer_size:
+            self.ac_in_buffer_size = min(self.ac_in_buffer_size * 2,
+                                         self.ac_in_buffer_max)
+        elif n < self.ac_in_buffer_size / 4:
+            self.ac_in_buffer_size = max(self.ac_in_buffer_size / 2,
+                                         self.ac_in_buffer_min)
+
     # grab some more data from the socket,
     # throw it to the collector method,
     # check for the terminator,
@@ -52,8 +74,10 @@ class Dispatcher (asyncore.dispatcher):
 
     def handle_read (self):
         """ Essentially copied from asynchat. Main differences are
-            SSL friendly recv error handling, and the removal of
-            some terminator cases which don't occur in Anomos """
+            SSL friendly recv error handling, the removal of
+            some terminator cases which don't occur in Anomos, and
+            that each read is walked with an offset rather than being
+            appended to and re-sliced from a buffer """
         try:
             data = self.recv (self.ac_in_buffer_size)
         except SSL.SSLError, err:
@@ -69,6 +93,7 @@ class Dispatcher (asyncore.dispatcher):
             return
         except Exception, e:
             log.info(e)
+            return
 
         # XXX: This is a hack. When a connection is closed abruptly
         # without a shutdown notification, we get left in a CLOSE_WAIT
@@ -84,26 +109,43 @@ class Dispatcher (asyncore.dispatcher):
             self.zero_count = 0
         ##############################################################
 
-        self.ac_in_buffer = self.ac_in_buffer + data
+        self._adapt_read_size(len(data))
 
-        # Continue to search for self.terminator in self.ac_in_buffer,
-        # while calling self.collect_incoming_data.  The while loop
-        # is necessary because we might read several data+terminator
-        # combos with a single recv(1024).
+        if self.ac_in_buffer:
+            # Only a partial terminator is ever carried between reads
+            data = self.ac_in_buffer + data
+            self.ac_in_buffer = ''
 
-        while self.ac_in_buffer:
-            lb = len(self.ac_in_buffer)
+        # Continue to search for self.terminator in data, while calling
+        # self.collect_incoming_data. The while loop is necessary
+        # because we might read several data+terminator combos with a
+        # single recv.
+
+        lb = len(data)
+        pos = 0
+        while pos < lb:
             terminator = self.get_terminator()
-            if isinstance(terminator, (int, long)):
+            if terminator is None:
+                # no terminator, collect it all and let the collector
+                # do its own framing
+                if pos:
+                    self.collect_incoming_data (data[pos:])
+                else:
+                    self.collect_incoming_data (data)
+                pos = lb
+            elif isinstance(terminator, (int, long)):
                 # numeric terminator
                 n = terminator
-                if lb < n:
-                    self.collect_incoming_data (self.ac_in_buffer)
-                    self.ac_in_buffer = ''
-                    self.terminator = self.terminator - lb
+                if lb - pos < n:
+                    if pos:
+                        self.collect_incoming_data (data[pos:])
+                    else:
+                        self.collect_incoming_data (data)
+                    self.terminator = n - (lb - pos)
+                    pos = lb
                 else:
-                    self.collect_incoming_data (self.ac_in_buffer[:n])
-                    self.ac_in_buffer = self.ac_in_buffer[n:]
+                    self.collect_incoming_data (data[pos:pos+n])
+                    pos += n
                     self.terminator = 0
                     self.found_terminator()
             else:
@@ -115,32 +157,40 @@ class Dispatcher (asyncore.dispatcher):
                 # 3) end of buffer does not match any prefix:
                 #    collect data
                 terminator_len = len(terminator)
-                index = self.ac_in_buffer.find(terminator)
+                index = data.find(terminator, pos)
                 if index != -1:
                     # we found the terminator
-                    if index > 0:
+                    if index > pos:
                         # don't bother reporting the empty string (source of subtle bugs)
-                        self.collect_incoming_data (self.ac_in_buffer[:index])
-                    self.ac_in_buffer = self.ac_in_buffer[index+terminator_len:]
+                        self.collect_incoming_data (data[pos:index])
+                    pos = index + terminator_len
                     # This does the Right Thing if the terminator is changed here.
                     self.found_terminator()
                 else:
                     # check for a prefix of the terminator
-                    index = find_prefix_at_end (self.ac_in_buffer, terminator)
+                    if lb - pos < terminator_len:
+                        index = find_prefix_at_end (data[pos:], terminator)
+                    else:
+                        index = find_prefix_at_end (data, terminator)
                     if index:
-                        if index != lb:
+                        if index != lb - pos:
                             # we found a prefix, collect up to the prefix
-                            self.collect_incoming_data (self.ac_in_buffer[:-index])
-                            self.ac_in_buffer = self.ac_in_buffer[-index:]
+                            self.collect_incoming_data (data[pos:-index])
+                        self.ac_in_buffer = data[-index:]
                         break
                     else:
                         # no prefix, collect it all
-                        self.collect_incoming_data (self.ac_in_buffer)
-                        self.ac_in_buffer = ''
+                        self.collect_incoming_data (data[pos:])
+                        pos = lb
 
     def handle_write (self):
         self.initiate_send ()
 
+    def del_channel (self, map=None):
+        if self._fileno is not None:
+            channel_closing(self._fileno, self)
+        asyncore.dispatcher.del_channel(self, map)
+
     def handle_close (self):
         self.close()
 
@@ -157,7 +207,16 @@ class Dispatcher (asyncore.dispatcher):
             self.handle_close()
 
     def push (self, data):
-        self.producer_fifo.push (simple_producer (data))
+        # Strings are copied straight into the output buffer by
+        # refill_buffer, no need to wrap them in a producer.
+        self.producer_fifo.push (data)
+        self.initiate_send()
+
+    def push_many (self, parts):
+        """ Push several strings (or memoryviews) with a single
+            send attempt """
+        for data in parts:
+            self.producer_fifo.push (data)
         self.initiate_send()
 
     def push_with_producer (self, producer):
@@ -168,12 +227,16 @@ class Dispatcher (asyncore.dispatcher):
         "predicate for inclusion in the readable for select()"
         return (len(self.ac_in_buffer) <= self.ac_in_buffer_size)
 
+    def out_buffered (self):
+        "number of bytes in the output buffer which have not been sent yet"
+        return len(self.ac_out_buffer) - self.ac_out_offset
+
     def writable (self):
         "predicate for inclusion in the writable for select()"
         # return len(self.ac_out_buffer) or len(self.producer_fifo) or (not self.connected)
         # this is about twice as fast, though not as clear.
         return not (
-                (self.ac_out_buffer == '') and
+                (self.ac_out_offset == len(self.ac_out_buffer)) and
                 self.producer_fifo.is_empty() and
                 self.connected
                 )
@@ -185,68 +248,81 @@ class Dispatcher (asyncore.dispatcher):
     # refill the outgoing buffer by calling the more() method
     # of the first producer in the queue
     def refill_buffer (self):
-        while 1:
+        obs = self.ac_out_buffer_size
+        while self.out_buffered() < obs:
             if len(self.producer_fifo):
                 p = self.producer_fifo.first()
                 # a 'None' in the producer fifo is a sentinel,
                 # telling us to close the channel.
                 if p is None:
-                    if not self.ac_out_buffer:
+                    if not self.out_buffered():
                         self.producer_fifo.pop()
                         self.handle_close()
                     return
-                elif isinstance(p, str):
+                elif isinstance(p, (str, memoryview)):
                     self.producer_fifo.pop()
-                    self.ac_out_buffer = self.ac_out_buffer + p
-                    return
+                    self.ac_out_buffer.extend(p)
+                    continue
                 data = p.more()
                 if data:
-                    self.ac_out_buffer = self.ac_out_buffer + data
-                    return
+                    self.ac_out_buffer.extend(data)
                 else:
                     self.producer_fifo.pop()
             else:
                 return
 
+    def _compact_out_buffer (self):
+        off = self.ac_out_offset
+        if off == len(self.ac_out_buffer):
+            del self.ac_out_buffer[:]
+            self.ac_out_offset = 0
+        elif off >= self.ac_out_compact_size and \
+                off * 2 >= len(self.ac_out_buffer):
+            del self.ac_out_buffer[:off]
+            self.ac_out_offset = 0
+
     def initiate_send (self):
         obs = self.ac_out_buffer_size
         # try to refill the buffer
-        if (len (self.ac_out_buffer) < obs):
+        if (self.out_buffered() < obs):
             self.refill_buffer()
 
-        if self.ac_out_buffer and self.connected:
+        if self.out_buffered() and self.connected:
             # try to send the buffer
             try:
-                num_sent = self._write_nbio(self.ac_out_buffer[:obs])
+                num_sent = self._write_nbio(
+                        buffer(self.ac_out_buffer, self.ac_out_offset, obs))
             except SSL.SSLError:
                 self.handle_error()
                 return
-            if num_sent:
-                self.ac_out_buffer = self.ac_out_buffer[num_sent:]
+            # _write_nbio returns -1 when SSL wants to retry the write
+            if num_sent > 0:
+                self.ac_out_offset += num_sent
+                self._compact_out_buffer()
 
     def discard_buffers (self):
         # Emergencies only!
         self.ac_in_buffer = ''
-        self.ac_out_buffer = ''
+        self.ac_out_buffer = bytearray()
+        self.ac_out_offset = 0
         while self.producer_fifo:
             self.producer_fifo.pop()
 
 
 class simple_producer:
 
-    def __init__ (self, data, buffer_size=1024):
+    def __init__ (self, data, buffer_size=16384):
         self.data = data
+        self.offset = 0
         self.buffer_size = buffer_size
 
     def more (self):
-        if len (self.data) > self.buffer_size:
-            result = self.data[:self.buffer_size]
-            self.data = self.data[self.buffer_size:]
-            return result
-        else:
-            result = self.data
+        result = self.data[self.offset:self.offset + self.buffer_size]
+        self.offset += len(result)
+        if self.offset >= len(self.data):
             self.data = ''
-            return result
+            self.offset = 0
+        return result
 
 class fifo:
     def __init__ (self, list=None):
@@ -17,7 +17,12 @@ from random import shuffle
 
 from Anomos import bttime, LOG as log
 from Anomos.Measure import Measure
-from Anomos.bitfield import Bitfield
+from Anomos.bitfield import Bitfield, full
+from Anomos.Protocol import E2E_FAST
+
+# The backlog covers this many round trips worth of data at the current
+# rate, so that it can grow when the rate is limited by the backlog itself
+BDP_GAIN = 2
 
 class PerStreamStats(object):
 
@@ -81,26 +86,71 @@ class SingleDownload(object):
         self.example_interest = None
         self.backlog = 2
         self.guard = BadDataGuard(self)
+        self.request_times = {} # {(index, begin, length) : time sent}
+        self.rtt = None # Smoothed time from request to piece
+        self.min_rtt = None
+        self.seed = False # Counted by picker.got_seed rather than per piece
+        self.allowed_fast = set() # Pieces we may request while choked
+        self.slice_size = downloader.chunksize # Length of our requests
 
     def _backlog(self):
-        backlog = 2 + int(4 * self.measure.get_rate() /
-                          self.downloader.chunksize)
-        if backlog > 50:
-            backlog = max(50, int(.075 * backlog))
+        rate = self.measure.get_rate()
+        if self.min_rtt is None:
+            # Nothing measured yet, assume a few seconds' worth
+            backlog = 2 + int(4 * rate / self.slice_size)
+        else:
+            # Enough requests to keep the circuit busy for a round trip.
+            # Samples beyond the smallest include time our own requests
+            # spent queued at the other end, the circuit's path itself
+            # doesn't change.
+            backlog = 2 + int(BDP_GAIN * rate * self.min_rtt /
+                              self.slice_size)
+        backlog = min(backlog, self.downloader.max_backlog)
         self.backlog = backlog
         return backlog
 
+    def _send_request(self, index, begin, length):
+        self.request_times[(index, begin, length)] = bttime()
+        self.stream.send_request(index, begin, length)
+
+    def _update_rtt(self, request):
+        sent = self.request_times.pop(request, None)
+        if sent is None:
+            return
+        sample = bttime() - sent
+        if self.rtt is None:
+            self.rtt = self.min_rtt = sample
+        else:
+            self.rtt = .875 * self.rtt + .125 * sample
+            self.min_rtt = min(self.min_rtt, sample)
+
+    def got_slice_size(self, length):
+        """ The other end serves requests up to length bytes long """
+        chunksize = self.downloader.chunksize
+        length = min(length, self.downloader.max_chunksize)
+        # StorageWrapper splits pieces at multiples of chunksize
+        self.slice_size = max(chunksize, length - length % chunksize)
+
+    def get_rtt(self):
+        """ @return: Smoothed request to piece round trip time in
+                     seconds, None if not yet measured """
+        return self.rtt
+
     def disconnected(self):
         self.downloader.lost_peer(self)
-        for i in xrange(len(self.have)):
-            if self.have[i]:
-                self.downloader.picker.lost_have(i)
+        if self.seed:
+            self.downloader.picker.lost_seed()
+        else:
+            for i in xrange(len(self.have)):
+                if self.have[i]:
+                    self.downloader.picker.lost_have(i)
         self._letgo()
         self.guard.download = None
 
     def _letgo(self):
         if not self.active_requests:
             return
+        self.request_times = {}
         if self.downloader.storage.endgame:
             self.active_requests = []
             return
@@ -110,6 +160,10 @@ class SingleDownload(object):
             if index not in lost:
                 lost.append(index)
         self.active_requests = []
+        self._reassign(lost)
+
+    def _reassign(self, lost):
+        """ Find other streams to request the pieces in lost from """
         ds = [d for d in self.downloader.downloads if not d.choked]
         shuffle(ds)
         for d in ds:
@@ -125,7 +179,37 @@ class SingleDownload(object):
     def got_choke(self):
         if not self.choked:
             self.choked = True
-            self._letgo()
+            if self.stream.e2e_extensions & E2E_FAST:
+                # Our outstanding requests will still be served or rejected
+                self._request_fast()
+            else:
+                self._letgo()
+
+    def got_reject(self, index, begin, length):
+        try:
+            self.active_requests.remove((index, begin, length))
+        except ValueError:
+            return
+        self.request_times.pop((index, begin, length), None)
+        if self.downloader.storage.endgame:
+            # Still in all_requests, someone else may pick it up
+            for d in self.downloader.downloads:
+                d.fix_download_endgame()
+            return
+        self.downloader.storage.request_lost(index, begin, length)
+        self._reassign([index])
+
+    def got_allowed_fast(self, index):
+        self.allowed_fast.add(index)
+        self._request_fast()
+
+    def _request_fast(self):
+        """ Request pieces we're allowed to while choked """
+        if not self.choked or self.downloader.storage.endgame:
+            return
+        want = [i for i in self.allowed_fast if self._want(i)]
+        if want:
+            self._request_more(want)
 
     def got_unchoke(self):
         if self.choked:
@@ -139,6 +223,7 @@ class SingleDownload(object):
         except ValueError:
             self.downloader.discarded_bytes += len(piece)
             return False
+        self._update_rtt((index, begin, len(piece)))
         if self.downloader.storage.endgame:
             self.downloader.all_requests.remove((index, begin, len(piece)))
         self.last = bttime()
@@ -171,9 +256,13 @@ class SingleDownload(object):
                             d.active_requests.remove((index, begin, len(piece)))
                         except ValueError:
                             continue
+                        d.request_times.pop((index, begin, len(piece)), None)
                         d.stream.send_cancel(index, begin, len(piece))
                         d.fix_download_endgame()
-        self._request_more()
+        if self.choked:
+            self._request_fast()
+        else:
+            self._request_more()
         if self.downloader.picker.am_I_complete():
             for d in [i for i in self.downloader.downloads if i.have.numfalse == 0]:
                 d.stream.close()
@@ -183,7 +272,8 @@ class SingleDownload(object):
         return self.have[index] and self.downloader.storage.do_I_have_requests(index)
 
     def _request_more(self, indices = None):
-        assert not self.choked
+        # Choked streams only request their allowed fast pieces
+        assert not self.choked or indices is not None
         if len(self.active_requests) >= self._backlog():
             return
         if self.downloader.storage.endgame:
@@ -207,9 +297,10 @@ class SingleDownload(object):
             self.example_interest = interest
             self.downloader.picker.requested(interest, self.have.numfalse == 0)
             while len(self.active_requests) < (self.backlog-2) * 5 + 2:
-                begin, length = self.downloader.storage.new_request(interest)
+                begin, length = self.downloader.storage.new_request(interest,
+                                                            self.slice_size)
                 self.active_requests.append((interest, begin, length))
-                self.stream.send_request(interest, begin, length)
+                self._send_request(interest, begin, length)
                 if not self.downloader.storage.do_I_have_requests(interest):
                     lost_interests.append(interest)
                     break
@@ -241,7 +332,10 @@ class SingleDownload(object):
                 d.fix_download_endgame()
 
     def fix_download_endgame(self):
-        want = [a for a in self.downloader.all_requests if self.have[a[0]] and a not in self.active_requests]
+        # Other streams' requests may be longer than this peer serves
+        want = [a for a in self.downloader.all_requests
+                    if self.have[a[0]] and a[2] <= self.slice_size and
+                       a not in self.active_requests]
         if self.interested and not self.active_requests and not want:
             self.interested = False
             self.stream.send_not_interested()
@@ -255,7 +349,7 @@ class SingleDownload(object):
         del want[self.backlog - len(self.active_requests):]
         self.active_requests.extend(want)
         for piece, begin, length in want:
-            self.stream.send_request(piece, begin, length)
+            self._send_request(piece, begin, length)
 
     def got_have(self, index):
         if self.have[index]:
@@ -279,11 +373,37 @@ class SingleDownload(object):
                 if not self.interested:
                     self.interested = True
                     self.stream.send_interested()
+                if index in self.allowed_fast:
+                    self._request_fast()
 
-    def got_have_bitfield(self, have):
-        if self.downloader.picker.am_I_complete() and have.numfalse == 0:
+    def got_have_all(self):
+        if self.downloader.picker.am_I_complete():
             self.stream.close()
             return
+        if self.have.numfalse < len(self.have):
+            # Pieces we were told about one by one
+            for i in xrange(len(self.have)):
+                if self.have[i]:
+                    self.downloader.picker.lost_have(i)
+        self.have = full(self.downloader.numpieces)
+        self.seed = True
+        self.downloader.picker.got_seed()
+        if self.downloader.storage.endgame:
+            if self.downloader.all_requests:
+                self.interested = True
+                self.stream.send_interested()
+            return
+        for i in xrange(len(self.have)):
+            if self.downloader.storage.do_I_have_requests(i):
+                self.interested = True
+                self.stream.send_interested()
+                break
+        self._request_fast()
+
+    def got_have_bitfield(self, have):
+        if have.numfalse == 0:
+            self.got_have_all()
+            return
         self.have = have
         for i in xrange(len(self.have)):
             if self.have[i]:
@@ -298,7 +418,8 @@ class SingleDownload(object):
             if self.have[i] and self.downloader.storage.do_I_have_requests(i):
                 self.interested = True
                 self.stream.send_interested()
-                return
+                break
+        self._request_fast()
 
     def get_rate(self):
         return self.measure.get_rate()
@@ -315,6 +436,8 @@ class Downloader(object):
         self.storage = storage
         self.picker = picker
         self.chunksize = config['download_slice_size']
+        self.max_chunksize = config['max_download_slice_size']
+        self.max_backlog = config['max_request_backlog']
         self.downmeasure = downmeasure
         self.numpieces = numpieces
         self.snub_time = config['snub_time']
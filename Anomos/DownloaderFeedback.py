@@ -63,6 +63,7 @@ class DownloaderFeedback(object):
             rec["download"] = (d.measure.get_total(),int(d.measure.get_rate()),
                                d.interested, d.choked, d.is_snubbed())
             rec['completed'] = 1 - float(d.have.numfalse) / len(d.have)
+            rec['rtt'] = d.get_rtt()
             rec['speed'] = d.connection.download.peermeasure.get_rate()
             l.append(rec)
         return l
@@ -71,13 +72,22 @@ class DownloaderFeedback(object):
         status = {}
         numSeeds = 0
         numPeers = 0
+        rtts = {}
         for d in self.downloader.downloads:
             if d.have.numfalse == 0:
                 numSeeds += 1
             else:
                 numPeers += 1
+            rtt = d.get_rtt()
+            if rtt is not None:
+                rtts[d.stream.uniq_id()] = rtt
         status['numSeeds'] = numSeeds
         status['numPeers'] = numPeers
+        # Request to piece round trip time of each stream
+        status['streamRTTs'] = rtts
+        status['streamRTT'] = None
+        if rtts:
+            status['streamRTT'] = sum(rtts.values()) / len(rtts)
         status['upRate'] = self.upfunc()
         status['upTotal'] = self.uptotal()
         status.update(self.relaystats()) # relayRate, relayCount, relaySent
@@ -93,7 +103,8 @@ class DownloaderFeedback(object):
                 numCopyList.append(fraction)
                 if fraction == 0 or len(numCopyList) >= 3:
                     break
-        numCopies -= numSeeds
+        # Seeds aren't counted in crosscount
+        numCopies += self.picker.seeds - numSeeds
         if self.picker.numgot == self.picker.numpieces:
             numCopies -= 1
         status['numCopies'] = numCopies
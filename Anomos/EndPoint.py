@@ -14,9 +14,13 @@
 # Originally written by Bram Cohen. Modified by John Schanck and Rich Jones
 
 from Anomos.Protocol.AnomosEndPointProtocol import AnomosEndPointProtocol
-from Anomos import LOG as log
+from Anomos.Protocol import E2E_EXTENSIONS, E2E_REBIND, E2E_HAVES
+from Anomos.RateLimiter import UPLOAD
+from Anomos import bttime, LOG as log
 
 class EndPoint(AnomosEndPointProtocol):
+    rate_class = UPLOAD
+    rate_weight = 1
     def __init__(self, stream_id, neighbor, torrent, aes, data=None):
         AnomosEndPointProtocol.__init__(self)
         self.partial_recv = ''
@@ -33,8 +37,25 @@ class EndPoint(AnomosEndPointProtocol):
         self.choker = None
         self.choke_sent = False
         self.upload = None
+        self.download = None
         self.next_upload = None
+        self.throttled = False # Neighbor's send queue is full
+        self.credit_window = neighbor.credit_window()
+        self.unacked = 0 # ENCRYPTED bytes received but not yet re-granted
+        self.started = None # When we sent our tracking code
+        self.e2e_extensions = 0 # End to end extensions both ends support
+        self.parked = False # Idle, waiting to be rebound to another torrent
+        self.rebinding = None # Infohash we've asked the other end to rebind to
+        self.rebind_tried = set() # Infohashes the other end has refused
+        self.rebinds_refused = 0 # REBIND requests we've said no to
+        # The torrent this circuit was built for. It's the only one the
+        # other end knows we share, so it's the only one a parked circuit
+        # can be rebound to without telling it about our others.
+        self.circuit_infohash = torrent.infohash
+        self.pending_haves = [] # Completed pieces not yet announced
+        self.have_flush = None # Scheduled flush_haves
         if data is not None:
+            self.started = bttime()
             self.send_tracking_code(data)
             log.info("Sending TC on EP %s" % self.uniq_id())
         else:
@@ -50,12 +71,144 @@ class EndPoint(AnomosEndPointProtocol):
             log.warning("Double complete")
             return
         self.complete = True
+        if self.started is not None:
+            self.manager.circuit_completed(bttime() - self.started)
+        if self.credit_window:
+            self.send_credit(self.credit_window)
+        # Ahead of everything else we send on the circuit
+        self.send_extensions()
+        self._attach(self.torrent)
+        log.info("Confirm received, EP %s is now active" % self.uniq_id())
+
+    def extensions_announced(self, bits):
+        self.e2e_extensions = bits & E2E_EXTENSIONS
+        if self.upload is not None:
+            self.upload.extensions_announced()
+
+    def _attach(self, torrent):
+        self.torrent = torrent
         self.upload = self.torrent.make_upload(self)
         self.choker = self.upload.choker
         self.choker.connection_made(self)
         self.download = self.torrent.make_download(self)
         self.torrent.add_active_stream(self)
-        log.info("Confirm received, EP %s is now active" % self.uniq_id())
+
+    def _detach(self):
+        self._drop_haves()
+        self.torrent.rm_active_stream(self)
+        self.choker.connection_lost(self)# Must come before changes to
+                                         # upload and download
+        self.download.disconnected()
+        self.choker = None
+        self.upload = None
+
+    ## Circuit reuse ##
+    def park(self):
+        """ Detach this circuit from its torrent and keep it open so it
+            can be rebound to another one.
+            @return: False if the circuit can't be kept """
+        if not self.complete or self.closed or self.sent_break or \
+                not self.e2e_extensions & E2E_REBIND:
+            return False
+        if not self.manager.park_circuit(self):
+            return False
+        log.info("Parking EP %s" % self.uniq_id())
+        if not self.choke_sent:
+            # Requests are ignored while parked, so don't leave the
+            # other end waiting on them
+            self.send_choke()
+        self._detach()
+        self.torrent = None
+        self.download = None
+        self.choke_sent = False
+        self.parked = True
+        self.rebind_tried.clear()
+        self.manager.offer_circuit(self)
+        return True
+
+    def rebind(self, infohash):
+        """ Ask the other end to reuse this circuit for infohash """
+        self.rebinding = infohash
+        self.send_rebind(infohash)
+
+    def rebind_requested(self, infohash):
+        torrent = None
+        if infohash == self.circuit_infohash:
+            # Whether we have any other torrent is none of its business
+            torrent = self.manager.get_torrent(infohash)
+        if torrent is None or \
+                (self.rebinding is not None and self.started is not None):
+            # Don't have it, or we're waiting on our own request and,
+            # having built the circuit, ours takes precedence
+            self.rebinds_refused += 1
+            if self.rebinds_refused > \
+                    self.manager.config['max_rebind_refusals']:
+                self.fatal_error("Too many refused REBIND requests")
+                return
+            self.send_rebind_ack(False, infohash)
+            return
+        self.rebinding = None
+        self.send_rebind_ack(True, infohash)
+        self._rebound(torrent)
+
+    def rebind_answered(self, accepted, infohash):
+        if infohash != self.rebinding:
+            return
+        self.rebinding = None
+        if not accepted:
+            self.rebind_tried.add(infohash)
+            if self.parked:
+                self.manager.offer_circuit(self)
+            return
+        torrent = self.manager.get_torrent(infohash)
+        if torrent is None:
+            # Removed while we were waiting
+            self.close()
+            return
+        self._rebound(torrent)
+
+    def _rebound(self, torrent):
+        if self.parked:
+            self.manager.unpark_circuit(self)
+            self.parked = False
+        elif self.torrent is not None:
+            self._detach()
+        self.manager.circuit_rebound()
+        self._attach(torrent)
+        log.info("EP %s rebound to a new torrent" % self.uniq_id())
+
+    ## HAVE batching ##
+    def queue_have(self, index):
+        """ Announce index with the next batch, unless the other end
+            already has it """
+        if self.download is not None and self.download.have[index]:
+            return
+        self.pending_haves.append(index)
+        if self.have_flush is None:
+            self.have_flush = self.manager.schedule(
+                    self.manager.config['have_batch_interval'],
+                    self.flush_haves)
+
+    def flush_haves(self):
+        self.have_flush = None
+        if self.closed or self.download is None:
+            self.pending_haves = []
+            return
+        # The other end may have announced some of these meanwhile
+        have = self.download.have
+        indices = [i for i in self.pending_haves if not have[i]]
+        self.pending_haves = []
+        if len(indices) > 1 and self.e2e_extensions & E2E_HAVES:
+            self.send_haves(indices)
+        else:
+            for i in indices:
+                self.send_have(i)
+
+    def _drop_haves(self):
+        if self.have_flush is not None:
+            self.have_flush.cancel()
+            self.have_flush = None
+        self.pending_haves = []
 
     def completion_timeout(self):
         if not self.complete:
@@ -69,6 +222,22 @@ class EndPoint(AnomosEndPointProtocol):
         if self.complete and self.should_queue():
             self.ratelimiter.queue(self)
 
+    def consumed(self, numbytes):
+        """ Return credit to our peer once we've processed
+            half a window """
+        if not self.credit_window or self.closed or self.neighbor is None:
+            return
+        self.unacked += numbytes
+        if self.unacked >= self.credit_window / 2:
+            self.send_credit(self.unacked)
+            self.unacked = 0
+
+    def queue_full(self):
+        self.throttled = True
+
+    def queue_drained(self):
+        self.throttled = False
+
     def should_queue(self):
         return self.next_upload is None and \
                 (self.neighbor.in_queue(self.stream_id) or getattr(self.upload, 'buffer', None))
@@ -88,19 +257,21 @@ class EndPoint(AnomosEndPointProtocol):
 
     def shutdown(self):
         log.info("Shutting down EP %s" % self.uniq_id())
-        if self.complete and not self.closed:
-            self.torrent.rm_active_stream(self)
-            self.choker.connection_lost(self)# Must come before changes to
-                                             # upload and download
-            self.download.disconnected()
-            self.choker = None
-            self.upload = None
+        if self.parked:
+            self.manager.unpark_circuit(self)
+            self.parked = False
+        elif self.complete and not self.closed:
+            self._detach()
         self.closed = True
-        self.ratelimiter.clean_closed()
+        self._drop_haves()
+        self.ratelimiter.remove(self)
 
     def got_exception(self, e):
         log.info("Exception on EP %s" % self.uniq_id())
-        self.torrent.handle_exception(e)
+        if self.torrent is not None:
+            self.torrent.handle_exception(e)
+        else:
+            log.error(e)
 
     def uniq_id(self):
         return "[%02x:%04x]" % (ord(self.neighbor.id), self.stream_id)
@@ -110,11 +281,19 @@ class EndPoint(AnomosEndPointProtocol):
         if self.closed:
             # Send nothing if the connection is closed.
             return 0
-        if self.complete and not self.neighbor.in_queue(self.stream_id):
+        if self.complete and not self.throttled and self.upload is not None \
+                and not self.neighbor.in_queue(self.stream_id):
             # Nothing queued, so grab a piece and queue it with neighbor
             s = self.upload.get_upload_chunk()
             if s is None:
                 return 0
             self.send_piece(*s) # s = (index, begin, piece)
         # Give neighbor permission to send "amount" bytes
-        return self.neighbor.send_partial(self.stream_id, amount)
+        sent = self.neighbor.send_partial(self.stream_id, amount)
+        if self.upload is not None and self.upload.buffer:
+            # More requests to serve once the socket drains
+            self.wait_for_flush()
+        return sent
+
+    def wait_for_flush(self):
+        self.neighbor.wait_for_flush(self.stream_id)
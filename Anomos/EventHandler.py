@@ -1,13 +1,50 @@
 import asyncore
-import bisect
+import heapq
 import os
 import threading
 import traceback
 
 from Anomos import bttime, LOG as log
+from Anomos.Poller import get_poller
+
+class Task(object):
+    """ Handle for a scheduled call. Returned by EventHandler.schedule
+        so that callers can cancel a pending timer without having the
+        queue rebuilt. """
+    __slots__ = ('when', 'func', 'context', 'record', 'handler')
+    def __init__(self, when, func, context, handler):
+        self.when = when
+        self.func = func
+        self.context = context
+        self.record = None
+        self.handler = handler
+
+    def cancel(self):
+        """ Prevent this task from running. The heap entry is dropped
+            lazily when it reaches the top of the queue. """
+        if self.func is None:
+            return
+        self.func = None
+        if self.record is not None and self.record.alive:
+            # Tasks of a removed context were already counted as dead
+            self.record.pending -= 1
+            self.handler._dead += 1
+
+    def active(self):
+        return self.func is not None and \
+                (self.record is None or self.record.alive)
+
+class _ContextRecord(object):
+    """ Bookkeeping for a context registered with add_context. Tasks keep a
+        reference to the record that was current when they were scheduled,
+        so removing (or re-adding) a context invalidates them in O(1). """
+    __slots__ = ('alive', 'pending')
+    def __init__(self):
+        self.alive = True
+        self.pending = 0
 
 class EventHandler(object):
-    def __init__(self, doneflag=None, map=None):
+    def __init__(self, doneflag=None, map=None, poller='auto'):
         if doneflag is not None:
             self.doneflag = doneflag
         else:
@@ -16,9 +53,12 @@ class EventHandler(object):
         self.map = map
         if self.map is None:
             self.map = asyncore.socket_map
+        self.poller = get_poller(poller)
 
-        self.contexts = {None : True}
-        self.tasks = [] # [[time, function, [arg0,...,argN]], ...]
+        self.contexts = {None : _ContextRecord()}
+        self.tasks = [] # Heap of (time, sequence, Task)
+        self._seq = 0
+        self._dead = 0 # Cancelled tasks still sitting in self.tasks
         self.externally_added = []
         self.thread = threading.currentThread()
 
@@ -33,36 +73,83 @@ class EventHandler(object):
             wakeup()
 
     def _external_schedule(self, delay, func, context=None):
-        self.externally_added.append([delay, func, context])
+        task = Task(delay, func, context, self)
+        self.externally_added.append(task)
         if self.wakeup is not None:
             self.wakeup.now()
+        return task
 
     def _pop_externally_added(self):
         while self.externally_added:
-            self.schedule(*self.externally_added.pop(0))
+            task = self.externally_added.pop(0)
+            if task.func is not None:
+                self._push(task, task.when)
 
     def add_context(self, context):
-        self.contexts[context] = True
+        if not self.contexts.has_key(context):
+            self.contexts[context] = _ContextRecord()
 
     def remove_context(self, context):
-        del self.contexts[context]
-        self.tasks = [x for x in self.tasks if x[2] != context]
+        record = self.contexts.pop(context)
+        record.alive = False
+        self._dead += record.pending
+        self._maybe_compact()
+
+    def _push(self, task, delay):
+        record = self.contexts.get(task.context)
+        if record is None:
+            task.func = None
+            return
+        task.when = bttime() + delay
+        task.record = record
+        record.pending += 1
+        self._seq += 1
+        heapq.heappush(self.tasks, (task.when, self._seq, task))
+
+    def _maybe_compact(self):
+        # Dead entries are normally discarded as they reach the top of the
+        # heap. If they come to dominate the queue, rebuild it in O(n) so
+        # that memory stays proportional to the number of live timers.
+        if self._dead > 1024 and self._dead * 2 > len(self.tasks):
+            self.tasks = [x for x in self.tasks if x[2].active()]
+            heapq.heapify(self.tasks)
+            self._dead = 0
 
     def schedule(self, delay, func, context=None):
-        """ Insert a task into the queue in a threadsafe manner """
+        """ Insert a task into the queue in a threadsafe manner.
+            @return: Task handle which may be used to cancel the call """
         if threading.currentThread() == self.thread:
-            if self.contexts.get(context, False):
-                bisect.insort(self.tasks, (bttime() + delay, func, context))
+            task = Task(None, func, context, self)
+            self._push(task, delay)
+            return task
         else:
-            self._external_schedule(delay, func, context)
+            return self._external_schedule(delay, func, context)
+
+    def _next_task_time(self):
+        """ Return the time of the earliest live task, discarding any
+            cancelled entries found at the top of the heap. """
+        while self.tasks:
+            task = self.tasks[0][2]
+            if task.active():
+                return task.when
+            heapq.heappop(self.tasks)
+            self._dead -= 1
+        return None
 
     def do_tasks(self):
         """ Do all tasks with timestamps <= than current time """
         context = None
         try:
-            while len(self.tasks) > 0 and self.tasks[0][0] <= bttime():
-                _, f, context = self.tasks.pop(0)
-                apply(f)
+            now = bttime()
+            while True:
+                when = self._next_task_time()
+                if when is None or when > now:
+                    break
+                _, _, task = heapq.heappop(self.tasks)
+                f, context = task.func, task.context
+                task.func = None
+                task.record.pending -= 1
+                f()
         except Exception, e:
             if context is not None:
                 context.got_exception(e)
@@ -72,10 +159,11 @@ class EventHandler(object):
             while not self.doneflag.isSet():
                 self._pop_externally_added()
                 period = 1e9
-                if len(self.tasks) > 0:
+                when = self._next_task_time()
+                if when is not None:
                     # Poll until the next task is set to execute
-                    period = max(0, self.tasks[0][0] - bttime())
-                asyncore.poll(period)
+                    period = max(0, when - bttime())
+                self.poller.poll(period, self.map)
                 self.do_tasks()
         except KeyboardInterrupt:
             #TODO: cleanup?
@@ -17,17 +17,17 @@
 from Anomos.EndPoint import EndPoint
 from Anomos.Relayer import Relayer
 from Anomos.PartialMessageQueue import PartialMessageQueue
+from Anomos.RateLimiter import CONTROL
 from Anomos.Protocol.AnomosNeighborProtocol import AnomosNeighborProtocol
-from Anomos.Protocol import NAT_CHECK_ID
-from Anomos import LOG as log
-
-from Anomos.Protocol import toint
+from Anomos.Protocol import NAT_CHECK_ID, LINK_STREAM_ID, EXT_CREDIT, EXT_PING
+from Anomos.Protocol.codec import FRAME_HEADER, FRAME_HEADER_LEN, MAX_STREAM_ID
+from Anomos import bttime, LOG as log
 
 class NeighborLink(AnomosNeighborProtocol):
     """ NeighborLink handles the socket between two neighbors and keeps
         track of the objects used to manage the active streams between
         those neighbors. """
-    def __init__(self, manager, socket, id, config, ratelimiter):
+    def __init__(self, manager, socket, id, config, ratelimiter, extensions=0):
         AnomosNeighborProtocol.__init__(self)
         self.socket = socket
         self.incoming_stream_id = 0
@@ -40,41 +40,111 @@ class NeighborLink(AnomosNeighborProtocol):
         self.next_stream_id = 0
         #else:
         #    self.next_stream_id = 1
-        self.pmq = PartialMessageQueue()
+        self.pmq = PartialMessageQueue(config['max_stream_queue'],
+                                       config['max_link_queue'],
+                                       self._stream_queue_full,
+                                       self._stream_queue_drained,
+                                       config['max_control_queue'])
         self.config = config
         self.ratelimiter = ratelimiter
+        # Whether streams on this link wait for CREDIT before sending
+        self.credit_enabled = bool(extensions & EXT_CREDIT)
+        # Liveness probing
+        self.rtt = None # Smoothed PING round trip time
+        self.ping_seq = 0
+        self.ping_time = None # When the unanswered PING ping_seq was sent
+        self.missed_pings = 0
+        self.got_data = False # Received anything since the last probe
+        if extensions & EXT_PING and config['ping_interval'] > 0:
+            self.manager.schedule(config['ping_interval'], self._probe)
+        # Streams with nothing queued whose producers are waiting for
+        # the socket to drain before they queue more
+        self.waiting = set()
 
         self.socket.set_collector(self)
         #Prepare to read messages
         self._reader = self._read_messages()
-        self._message = ''
+        self._header = '' # Partial frame header left over from the last read
+        self._frame = None # Preallocated payload of a frame spanning reads
+        self._frame_sid = None
+        self._frame_filled = 0
 
     def get_reader(self):
         return self._reader
 
-    def collect_incoming_data(self, data):
-        self._message += data
-
     def _read_messages(self):
-        """ Read messages off the line and relay or process them
-            depending on connection type """
+        """ Frames are decoded straight out of each read by
+            collect_incoming_data, so ask the socket for everything """
         while True:
-            yield 2 # Stream ID
-            stream = toint(self._message)
-            handler = self.get_stream_handler(stream)
-            self._message = ''
-            yield 4   # Message Length
-            l = toint(self._message)
-            if l > self.config['max_message_length']:
-                log.warning("Received message longer than max length")
-            #    return
-            self._message = ''
-            yield l # Payload
-            if handler == self:
-                # Grab the stream ID to initialize the received stream
-                self.incoming_stream_id = stream
-            handler.got_message(self._message)
-            self._message = ''
+            yield None
+
+    def collect_incoming_data(self, data):
+        """ Decode and dispatch every complete frame in data. Only a frame
+            which spans reads is copied into a buffer of its own. """
+        self.got_data = True
+        pos = 0
+        end = len(data)
+        if self._frame is not None:
+            pos = self._fill_frame(data, pos)
+            if pos is None or self._frame is not None:
+                return
+        if self._header:
+            need = FRAME_HEADER_LEN - len(self._header)
+            self._header += data[pos:pos+need]
+            pos = min(pos + need, end)
+            if len(self._header) < FRAME_HEADER_LEN:
+                return
+            stream, length = FRAME_HEADER.unpack(self._header)
+            self._header = ''
+            pos = self._start_frame(stream, length, data, pos)
+        while pos is not None and self._frame is None:
+            if end - pos < FRAME_HEADER_LEN:
+                if pos < end:
+                    self._header = data[pos:]
+                return
+            stream, length = FRAME_HEADER.unpack_from(data, pos)
+            pos = self._start_frame(stream, length, data,
+                                    pos + FRAME_HEADER_LEN)
+
+    def _start_frame(self, stream, length, data, pos):
+        """ Dispatch the frame whose payload starts at data[pos] if it is
+            complete, otherwise start buffering it. Returns the offset of
+            the next frame, or None if the link was closed. """
+        if length > self.config['max_message_length']:
+            log.warning("Received message longer than max length")
+            self.socket.close()
+            return None
+        if len(data) - pos >= length:
+            self._got_frame(stream, data[pos:pos+length])
+            if self.socket is None:
+                return None
+            return pos + length
+        self._frame = bytearray(length)
+        self._frame_sid = stream
+        self._frame_filled = 0
+        return self._fill_frame(data, pos)
+
+    def _fill_frame(self, data, pos):
+        f = self._frame_filled
+        n = min(len(self._frame) - f, len(data) - pos)
+        self._frame[f:f+n] = data[pos:pos+n]
+        self._frame_filled = f + n
+        if self._frame_filled == len(self._frame):
+            payload = str(self._frame)
+            self._frame = None
+            self._got_frame(self._frame_sid, payload)
+            if self.socket is None:
+                return None
+        return pos + n
+
+    def _got_frame(self, stream, payload):
+        if not payload:
+            return
+        handler = self.get_stream_handler(stream)
+        if handler == self and stream != LINK_STREAM_ID:
+            # Grab the stream ID to initialize the received stream
+            self.incoming_stream_id = stream
+        handler.got_message(payload)
 
     ## Stream Management ##
     def start_endpoint_stream(self, torrent, aeskey, data=None):
@@ -88,12 +158,14 @@ class NeighborLink(AnomosNeighborProtocol):
             @return: Newly created EndPoint object"""
         if data is None: # Incoming stream
             nxtid = self.incoming_stream_id
-            self.next_stream_id = nxtid + 1
+            self.next_stream_id = (nxtid + 1) % (MAX_STREAM_ID + 1)
         else: # Localy initialized stream
-            nxtid = self.next_stream_id
-            self.next_stream_id += 1
+            nxtid = self._new_stream_id()
+        if self.credit_enabled:
+            self.pmq.limit_credit(nxtid)
         self.streams[nxtid] = \
                     EndPoint(nxtid, self, torrent, aeskey, data)
+        self.manager.stream_started(self)
         self.manager.schedule(180, self.streams[nxtid].completion_timeout)
         return self.streams[nxtid]
 
@@ -109,15 +181,26 @@ class NeighborLink(AnomosNeighborProtocol):
             @return: Newly created Relayer object"""
         if orelay is None: # Incoming stream
             nxtid = self.incoming_stream_id
-            self.next_stream_id = nxtid + 1
+            self.next_stream_id = (nxtid + 1) % (MAX_STREAM_ID + 1)
         else: # Locally initialized stream
-            nxtid = self.next_stream_id
-            self.next_stream_id += 1
+            nxtid = self._new_stream_id()
+        if self.credit_enabled:
+            self.pmq.limit_credit(nxtid)
         self.streams[nxtid] = \
                     Relayer(nxtid, self, nid, data, orelay)
+        self.manager.stream_started(self)
         self.manager.schedule(180, self.streams[nxtid].completion_timeout)
         return self.streams[nxtid]
 
+    def _new_stream_id(self):
+        """ Stream IDs wrap around on long lived links, skipping those
+            still in use and the one reserved for the link itself """
+        nxtid = self.next_stream_id
+        while nxtid in self.streams or nxtid == LINK_STREAM_ID:
+            nxtid = (nxtid + 1) % (MAX_STREAM_ID + 1)
+        self.next_stream_id = (nxtid + 1) % (MAX_STREAM_ID + 1)
+        return nxtid
+
     def close_all_streams(self):
         for s in self.streams.values():
             if not s.closed:
@@ -130,8 +213,10 @@ class NeighborLink(AnomosNeighborProtocol):
             @param id: Stream id of stream to end
             @type id: int in range 0 to 2**16"""
         self.pmq.remove_by_sid(id)
+        self.waiting.discard(id)
         if self.streams.has_key(id):
             del self.streams[id]
+            self.manager.stream_ended(self)
 
     def get_stream_handler(self, id):
         """ Return the handler associated with streamid, otherwise
@@ -142,41 +227,144 @@ class NeighborLink(AnomosNeighborProtocol):
         return self.streams.get(id, self)
 
     def socket_flushed(self):
-        """ Inform all streams that the connection is
-            flushed so they may requeue themselves if
-            they need to """
-        for stream in self.streams.itervalues():
-            stream.socket_flushed()
+        """ Inform the streams which have queued output or are waiting
+            on the socket that the connection is flushed so they may
+            requeue themselves if they need to. Idle streams are skipped. """
+        self._send_control()
+        waiting = self.waiting
+        self.waiting = set()
+        sids = self.pmq.ready_streams()
+        sids.extend(waiting.difference(sids))
+        for sid in sids:
+            stream = self.streams.get(sid)
+            if stream is not None:
+                self.manager.flush_wakeups += 1
+                stream.socket_flushed()
+
+    def wait_for_flush(self, sid):
+        """ Wake stream sid on the next socket_flushed even if it
+            has nothing queued """
+        self.waiting.add(sid)
 
     def send_immediately(self, message):
         self.socket.push(message)
+        self.ratelimiter.spent(CONTROL, len(message))
 
-    def queue_message(self, streamid, message):
+    def queue_message(self, streamid, message, control=False):
+        """ Queue a message for sending on stream streamid. Control
+            messages are sent ahead of the data of every stream the
+            next time the socket drains. """
         t = self.streams.has_key(streamid)
         if not t or (t and not self.streams[streamid].sent_break):
-            self.pmq.queue_message(streamid, message)
+            self.pmq.queue_message(streamid, message, control)
         if self.socket.flushed():
             self.socket_flushed()
 
+    def _send_control(self):
+        for sid, message in self.pmq.dequeue_control():
+            self.send_immediately(self.format_message(sid, message))
+
     def in_queue(self, id):
-        return self.pmq.msgs.has_key(id) and len(self.pmq.msgs[id]) > 0
+        return self.pmq.has_queued(id)
+
+    def queued_bytes(self, id):
+        return self.pmq.queued_bytes(id)
+
+    def queued_total(self):
+        """ Bytes queued for sending on all streams of this link """
+        return len(self.pmq)
+
+    def add_credit(self, sid, numbytes):
+        """ The remote end of stream sid granted it numbytes more """
+        if self.pmq.add_credit(sid, numbytes) and self.socket.flushed():
+            stream = self.streams.get(sid)
+            if stream is not None:
+                stream.socket_flushed()
+
+    def credit_window(self):
+        """ Credit each of our streams grants its remote end,
+            or 0 if this link doesn't do flow control """
+        if self.credit_enabled:
+            return self.config['stream_credit_window']
+        return 0
+
+    def _stream_queue_full(self, sid):
+        stream = self.streams.get(sid)
+        if stream is not None:
+            stream.queue_full()
+
+    def _stream_queue_drained(self, sid):
+        stream = self.streams.get(sid)
+        if stream is not None:
+            stream.queue_drained()
+
+    def pause_reading(self):
+        if self.socket is not None:
+            self.socket.pause_reading()
+
+    def resume_reading(self):
+        if self.socket is not None:
+            self.socket.resume_reading()
 
     def send_partial(self, sid, numbytes):
         """ Requests numbytes from the PartialMessageQueue
             to be sent.
             @return: Actual number of bytes sent."""
+        # Anything in the control lane has to go out first
+        self._send_control()
         msgs = self.pmq.dequeue_partial(sid, numbytes)
         if len(msgs) == 0:
             return 0
         #TODO: There should really be some kind of error handling here
         #      if this write fails.
         snt = 0
-        for i in range(len(msgs)):
-            f = self.format_message(sid, msgs[i])
-            self.socket.push(f)
-            snt += len(f)
+        for parts in msgs:
+            length = sum([len(p) for p in parts])
+            self.socket.push_many((FRAME_HEADER.pack(sid, length),) + parts)
+            snt += FRAME_HEADER_LEN + length
+        self.manager.bytes_flushed += snt
         return snt
 
+    ## Liveness ##
+    def _probe(self):
+        """ Send a PING every ping_interval. A neighbor which sends us
+            nothing at all, not even a PONG, for ping_max_missed probes
+            in a row is dropped so that its circuits close early. """
+        if self.socket is None:
+            return
+        if self.ping_time is not None:
+            if self.got_data or self.socket.read_paused:
+                # Alive, or we just haven't been reading its answers
+                self.missed_pings = 0
+            else:
+                self.missed_pings += 1
+                if self.missed_pings >= self.config['ping_max_missed']:
+                    log.warning("Neighbor %s missed %d probes, dropping it" %
+                                (self.uniq_id(), self.missed_pings))
+                    self.socket.close()
+                    return
+        self.got_data = False
+        self.ping_seq = (self.ping_seq + 1) & 0xFFFFFFFF
+        self.ping_time = bttime()
+        self.send_ping(self.ping_seq)
+        self.manager.schedule(self.config['ping_interval'], self._probe)
+
+    def pong_received(self, seq):
+        if seq != self.ping_seq or self.ping_time is None:
+            return # Answer to a probe we already gave up on
+        sample = bttime() - self.ping_time
+        self.ping_time = None
+        self.missed_pings = 0
+        if self.rtt is None:
+            self.rtt = sample
+        else:
+            self.rtt = .875 * self.rtt + .125 * sample
+
+    def get_rtt(self):
+        """ @return: Smoothed round trip time in seconds,
+                     None if not yet measured """
+        return self.rtt
+
     def socket_closed(self):
         self.close_all_streams()
         self.manager.rm_neighbor(self.id)
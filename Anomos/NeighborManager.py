@@ -19,30 +19,48 @@ import Anomos.Crypto
 
 from Anomos.AnomosNeighborInitializer import AnomosNeighborInitializer
 from Anomos.NeighborLink import NeighborLink
-from Anomos.P2PConnection import P2PConnection
+from Anomos.P2PConnection import P2PConnection, ConnectLimiter
 from Anomos.TCReader import TCReader
 from Anomos.Protocol import NAT_CHECK_ID
 from Anomos.Measure import Measure
-from Anomos import BTFailure, LOG as log
+from Anomos import bttime, BTFailure, LOG as log
 
 class NeighborManager(object):
     """NeighborManager keeps track of the neighbors a peer is connected to
     and which tracker those neighbors are on.
     """
-    def __init__(self, config, certificate, ssl_ctx, sessionid, schedule, ratelimiter):
+    def __init__(self, config, certificate, ssl_ctx, sessionid, schedule,
+                 ratelimiter, downloadlimiter=None):
         self.config = config
         self.certificate = certificate
         self.ssl_ctx = ssl_ctx
         self.sessionid = sessionid
         self.schedule = schedule
         self.ratelimiter = ratelimiter
+        self.downloadlimiter = downloadlimiter
         self.neighbors = {}
+        self.neighbor_ips = {} # {NID : IP} of self.neighbors
+        self.ips = {} # {IP : number of neighbors and incomplete connections}
+        self.stream_count = 0 # Streams on all of self.neighbors
         self.relay_measure = Measure(self.config['max_rate_period'])
-        self.relays = []
-        self.incomplete = {}
+        self.relays = {} # {Relayer : the other half of its relay}
+        self.incomplete = {} # {NID : (IP, Port)}
+        self.incomplete_locs = {} # {(IP, Port) : NID}
         self.torrents = {}
         self.waiting_tcs = {}
-        self.failedPeers = []
+        self.failedPeers = {} # {NID : time at which to forget the failure}
+        self.connect_limiter = ConnectLimiter(config['max_concurrent_connects'])
+        # Streams woken by NeighborLink.socket_flushed, and the stream
+        # bytes sent in response
+        self.flush_wakeups = 0
+        self.bytes_flushed = 0
+        # Time from sending a tracking code to receiving its CONFIRM
+        self.circuit_latency = 0.0
+        self.circuits_completed = 0
+        # Idle EndPoint circuits kept open for reuse by other torrents
+        self.circuit_pool = {} # {NID : [EndPoint, ...]}
+        self.pool_timeouts = {} # {EndPoint : Task closing it}
+        self.circuits_rebound = 0
 
     ## Got new neighbor list from the tracker ##
     def update_neighbor_list(self, list):
@@ -59,7 +77,7 @@ class NeighborManager(object):
                 # To be safe, kill connection with the neighbor we already
                 # had with the requested ID and add ID to the failed list
                 self.rm_neighbor(id)
-            elif (not self.has_neighbor(id)) and (id not in self.failedPeers):
+            elif (not self.has_neighbor(id)) and (not self.has_failed(id)):
                 self.start_connection(id, loc)
 
     ## Start a new neighbor connection ##
@@ -76,52 +94,103 @@ class NeighborManager(object):
                         'Multiple connections to the same IP are disabled ' \
                         'in your config.')
             return
-        self.incomplete[id] = loc
+        self._set_incomplete(id, loc)
         conn = P2PConnection(addr=loc,
                              ssl_ctx=self.ssl_ctx,
                              connect_cb=self.socket_cb,
-                             schedule=self.schedule)
+                             schedule=self.schedule,
+                             connect_timeout=self.config['connect_timeout'],
+                             connect_limiter=self.connect_limiter)
 
     def socket_cb(self, sock):
         """ Called by P2PConnection after connect() has completed """
         if sock.connected:
             log.info('Connected to %s:%d' % sock.addr)
-            for id,v in self.incomplete.iteritems():
-                if v == sock.addr:
-                    break
-            else:
+            id = self.incomplete_locs.get(tuple(sock.addr))
+            if id is None:
                 return #loc wasn't found
             AnomosNeighborInitializer(self, sock, id)
         else:
             #Remove nid,loc pair from incomplete
-            for k,v in self.incomplete.iteritems():
-                if v == sock.addr:
-                    log.info('Discarding neighbor \\x%02x @ %s:%d' %
-                                (ord(k), sock.addr[0], sock.addr[1]))
-                    self.rm_neighbor(j)
+            k = self.incomplete_locs.get(tuple(sock.addr))
+            if k is not None:
+                log.info('Discarding neighbor \\x%02x @ %s:%d' %
+                            (ord(k), sock.addr[0], sock.addr[1]))
+                self.rm_neighbor(k)
+
+    ## Failed neighbors ##
+    # Failed NIDs are reported to the tracker and forgotten once it has
+    # them, or after failed_peer_ttl seconds if it never acknowledges them.
+    def _expire_failed(self):
+        now = bttime()
+        for nid, expires in self.failedPeers.items():
+            if expires <= now:
+                del self.failedPeers[nid]
+
+    def has_failed(self, nid):
+        expires = self.failedPeers.get(nid)
+        if expires is None:
+            return False
+        if expires <= bttime():
+            del self.failedPeers[nid]
+            return False
+        return True
 
     def failed_connections(self):
-        return self.failedPeers
+        self._expire_failed()
+        return self.failedPeers.keys()
 
     def remove_reported_failids(self, failids):
         for i in failids:
-            if i in self.failedPeers:
-                self.failedPeers.remove(i)
+            self.failedPeers.pop(i, None)
+
+    ## IP index ##
+    def _add_ip(self, ip):
+        self.ips[ip] = self.ips.get(ip, 0) + 1
+
+    def _rm_ip(self, ip):
+        n = self.ips.get(ip, 0) - 1
+        if n > 0:
+            self.ips[ip] = n
+        else:
+            self.ips.pop(ip, None)
+
+    def _set_incomplete(self, nid, loc):
+        self._rm_incomplete(nid)
+        self.incomplete[nid] = loc
+        self.incomplete_locs[tuple(loc)] = nid
+        self._add_ip(loc[0])
+
+    def _rm_incomplete(self, nid):
+        loc = self.incomplete.pop(nid, None)
+        if loc is not None:
+            if self.incomplete_locs.get(tuple(loc)) == nid:
+                del self.incomplete_locs[tuple(loc)]
+            self._rm_ip(loc[0])
 
     ## AnomosNeighborInitializer got a full handshake ##
-    def add_neighbor(self, socket, id):
+    def add_neighbor(self, socket, id, extensions=0):
+        self._rm_link(id)
         self.neighbors[id] = NeighborLink(self, socket, id, \
-                self.config, self.ratelimiter)
+                self.config, self.ratelimiter, extensions)
+        if self.downloadlimiter is not None:
+            self.downloadlimiter.add(socket)
+        self.neighbor_ips[id] = socket.addr[0]
+        self._add_ip(socket.addr[0])
         log.info("Added Neighbor: \\x%02x @ %s:%d" %
                                  (ord(id), socket.addr[0], socket.addr[1]))
 
+    def _rm_link(self, nid):
+        link = self.neighbors.pop(nid, None)
+        if link is not None:
+            self.stream_count -= len(link.streams)
+            self._rm_ip(self.neighbor_ips.pop(nid))
+
     def rm_neighbor(self, nid):
-        if self.incomplete.has_key(nid):
-            self.incomplete.pop(nid)
-        if self.neighbors.has_key(nid):
-            self.neighbors.pop(nid)
+        self._rm_incomplete(nid)
+        self._rm_link(nid)
         if nid is not None:
-            self.failedPeers.append(nid)
+            self.failedPeers[nid] = bttime() + self.config['failed_peer_ttl']
             log.info("Removed Neighbor: \\x%02x" % ord(nid))
 
     #TODO: implement banning
@@ -143,8 +212,7 @@ class NeighborManager(object):
         return sid == self.sessionid
 
     def has_ip(self, ip):
-        return ip in [n.socket.addr[0] for n in self.neighbors.values()] \
-                or ip in [x for x,y in self.incomplete.values()]
+        return self.ips.has_key(ip)
 
     def get_ips(self):
         ips = []
@@ -158,14 +226,13 @@ class NeighborManager(object):
     def count(self, tracker=None):
         return len(self.neighbors)
 
-    def connection_completed(self, socket, id):
+    def connection_completed(self, socket, id, extensions=0):
         """Called by AnomosNeighborInitializer"""
-        if self.incomplete.has_key(id):
-            del self.incomplete[id]
+        self._rm_incomplete(id)
         if id == NAT_CHECK_ID:
             log.info("NAT check ok.")
             return
-        self.add_neighbor(socket, id)
+        self.add_neighbor(socket, id, extensions)
         tasks = self.waiting_tcs.get(id)
         if tasks is None:
             return
@@ -199,7 +266,7 @@ class NeighborManager(object):
             log.error("Not starting circuit -- SessionID mismatch!")
         elif torrent is None:
             log.error("Not starting circuit -- Unknown torrent")
-        elif nid in self.failedPeers:
+        elif self.has_failed(nid):
             log.info("Not starting circuit -- no longer connected to \\x%02x" % ord(nid))
         elif nid in self.incomplete:
             log.info("Postponing circuit until neighbor \\x%02x completes " % ord(nid))
@@ -226,49 +293,174 @@ class NeighborManager(object):
             raise BTFailure("Can't start two separate instances of the same "
                             "torrent")
         self.torrents[infohash] = torrent
+        self.rebind_circuits(infohash)
 
     def remove_torrent(self, infohash):
-        self.torrents[infohash].close_all_streams()
-        del self.torrents[infohash]
-        if len(self.torrents) == 0:
-            # Close all streams when the last torrent is removed
-            for n in self.neighbors.values():
+        torrent = self.torrents.pop(infohash)
+        # Keep what circuits we can for the other torrents
+        for s in torrent.active_streams[:]:
+            if not s.closed and not s.park():
+                s.close()
+        self.close_idle_neighbors()
+
+    def close_idle_neighbors(self):
+        """ Once the last torrent is removed, close the links to every
+            neighbor we don't have parked circuits with. The rest are
+            closed when their parked circuits expire. """
+        if len(self.torrents) > 0:
+            return
+        for nid, n in self.neighbors.items():
+            if nid not in self.circuit_pool:
                 n.socket.handle_close()
 
     def get_torrent(self, infohash):
         return self.torrents.get(infohash, None)
 
     def count_streams(self):
-        return sum(len(x.streams) for x in self.neighbors.itervalues())
+        return self.stream_count
+
+    def stream_started(self, link):
+        """ Called by NeighborLink when it adds a stream """
+        if self.neighbors.get(link.id) is link:
+            self.stream_count += 1
+
+    def stream_ended(self, link):
+        """ Called by NeighborLink when it removes a stream """
+        if self.neighbors.get(link.id) is link:
+            self.stream_count -= 1
 
     ## Relay Management ##
     def make_relay(self, nid, data, orelay):
         if self.neighbors.has_key(nid):
             r = self.neighbors[nid].start_relay_stream(nid, data, orelay)
             orelay.set_other_relay(r)
-            self.relays.append((orelay, r))
+            self.relays[orelay] = r
+            self.relays[r] = orelay
         elif self.incomplete.has_key(nid):
             def relay_tc():
                 r = self.neighbors[nid].start_relay_stream(nid,data,orelay)
                 orelay.set_other_relay(r)
-                self.relays.append((orelay, r))
+                self.relays[orelay] = r
+                self.relays[r] = orelay
             self.waiting_tcs.setdefault(nid, [])
             self.waiting_tcs[nid].append(relay_tc)
 
     def rm_relay(self, relay):
-        for i in range(len(self.relays)):
-            if relay in self.relays[i]:
-                self.relays.remove(self.relays[i])
-                break
+        other = self.relays.pop(relay, None)
+        if other is not None:
+            self.relays.pop(other, None)
 
     def get_relay_count(self):
-        return len(self.relays)
+        return len(self.relays) / 2
 
     def get_relay_stats(self):
         rate = self.relay_measure.get_rate()
-        count = len(self.relays)
+        count = self.get_relay_count()
         sent = self.relay_measure.get_total()
         return {'relayRate' : rate, 'relayCount' : count, 'relaySent' : sent}
 
+    def get_connect_stats(self):
+        return self.connect_limiter.get_stats()
+
+    def circuit_completed(self, latency):
+        self.circuits_completed += 1
+        if self.circuits_completed == 1:
+            self.circuit_latency = latency
+        else:
+            self.circuit_latency = .8 * self.circuit_latency + .2 * latency
+
+    def get_circuit_stats(self):
+        return {'circuitSetupLatency' : self.circuit_latency,
+                'circuitsCompleted' : self.circuits_completed,
+                'circuitsPooled' : sum([len(p) for p in
+                                        self.circuit_pool.itervalues()]),
+                'circuitsRebound' : self.circuits_rebound}
+
+    ## Circuit pool ##
+    # Circuits (tracking code round trips through several relays) are
+    # expensive to set up and can only be built from tracking codes the
+    # tracker hands out, so rather than closing the circuits of a removed
+    # torrent, up to circuit_pool_size per neighbor are parked and rebound,
+    # via an authenticated REBIND, if the torrent is added again. They're
+    # never offered to any other torrent, that would tell the anonymous
+    # other end which torrents we have. Parked circuits which nobody wants
+    # are closed after circuit_pool_timeout.
+    def park_circuit(self, endpoint):
+        nid = endpoint.neighbor.id
+        pool = self.circuit_pool.setdefault(nid, [])
+        if len(pool) >= self.config['circuit_pool_size']:
+            if not pool:
+                del self.circuit_pool[nid]
+            return False
+        pool.append(endpoint)
+        def expire():
+            self.pool_timeouts.pop(endpoint, None)
+            if endpoint.parked and not endpoint.closed:
+                log.info("Closing unused parked EP %s" % endpoint.uniq_id())
+                endpoint.close()
+        self.pool_timeouts[endpoint] = \
+                self.schedule(self.config['circuit_pool_timeout'], expire)
+        return True
+
+    def unpark_circuit(self, endpoint):
+        task = self.pool_timeouts.pop(endpoint, None)
+        if task is not None:
+            task.cancel()
+        for nid, pool in self.circuit_pool.items():
+            if endpoint in pool:
+                pool.remove(endpoint)
+                if not pool:
+                    del self.circuit_pool[nid]
+                    if not self.torrents:
+                        # Not from inside the endpoint's shutdown
+                        self.schedule(0, self.close_idle_neighbors)
+                break
+
+    def rebind_circuits(self, infohash):
+        """ Rebind the idle parked circuits which were built for the
+            torrent infohash """
+        for pool in self.circuit_pool.values():
+            for endpoint in pool:
+                if endpoint.circuit_infohash == infohash:
+                    self.offer_circuit(endpoint)
+
+    def offer_circuit(self, endpoint):
+        """ Try to rebind a parked circuit to the torrent it was built
+            for, if we have it and the other end hasn't refused it """
+        infohash = endpoint.circuit_infohash
+        if endpoint.rebinding is None and infohash in self.torrents and \
+                infohash not in endpoint.rebind_tried:
+            endpoint.rebind(infohash)
+
+    def circuit_rebound(self):
+        self.circuits_rebound += 1
+
+    def get_link_rtts(self):
+        """ @return: {NID : smoothed round trip time} for the neighbors
+                     which have answered a PING """
+        rtts = {}
+        for nid, link in self.neighbors.iteritems():
+            rtt = link.get_rtt()
+            if rtt is not None:
+                rtts[nid] = rtt
+        return rtts
+
+    def get_link_stats(self):
+        rtts = self.get_link_rtts()
+        mean = 0.0
+        if rtts:
+            mean = sum(rtts.values()) / len(rtts)
+        return {'neighborRTT' : mean,
+                'neighborRTTs' : dict([('%02x' % ord(nid), rtt)
+                                       for nid, rtt in rtts.iteritems()])}
+
+    def get_flush_stats(self):
+        per_byte = 0.0
+        if self.bytes_flushed:
+            per_byte = float(self.flush_wakeups) / self.bytes_flushed
+        return {'flushWakeups' : self.flush_wakeups,
+                'flushBytes' : self.bytes_flushed,
+                'flushWakeupsPerByte' : per_byte}
+
     def relayed(self):
         return self.relay_measure.get_total()
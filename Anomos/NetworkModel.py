@@ -83,7 +83,10 @@ class SimPeer:
         if rl is not None:
             self.relayed_total = rl
         # Remove any stopped torrents
-        if params.get('event') == 'stopped':
+        if ihash is None:
+            # Relay only announce
+            pass
+        elif params.get('event') == 'stopped':
             if self.infohashes.has_key(ihash):
                 del self.infohashes[ihash]
         else:
@@ -235,7 +238,8 @@ class NetworkModel:
                 self.reachable.add(peerid)
             if simpeer.nbrs_needed > 0:
                 self.rand_connect(peerid, simpeer.nbrs_needed)
-            self.update_swarm(peerid, infohash, complete)
+            if infohash is not None:
+                self.update_swarm(peerid, infohash, complete)
 
 
     def update_swarm(self, peerid, infohash, complete):
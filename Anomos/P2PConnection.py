@@ -15,30 +15,42 @@
 
 # Written by John Schanck and Rich Jones
 
+import asyncore
 import asynchat
+import os
 import socket
-import threading
+import sys
 
-from Anomos import LOG as log
+from collections import deque
+from errno import EINPROGRESS, EWOULDBLOCK, EALREADY
+from Anomos import bttime, LOG as log
 from Anomos.Dispatcher import Dispatcher
 from M2Crypto import SSL
 
 class P2PConnection(Dispatcher):
     def __init__(self, socket=None, addr=None, ssl_ctx=None, connect_cb=None,
-            schedule=None):
+            schedule=None, connect_timeout=10, connect_limiter=None):
         Dispatcher.__init__(self, socket)
 
         self.ssl_ctx = ssl_ctx
         self.connect_cb = connect_cb
         self.schedule = schedule
+        self.connect_timeout = connect_timeout
+        self.connect_limiter = connect_limiter
+        self.connect_started = None
         self.collector = None
         self.new_collector = False
         self.started_locally = (addr is not None)
         self.want_write = False
+        self.read_paused = 0
+        self.download_limiter = None # Set by DownloadLimiter.add
 
         if self.started_locally:
-            t = threading.Thread(target=self.connect, args=(addr,))
-            t.start()
+            self.addr = addr
+            if connect_limiter is not None:
+                connect_limiter.request(lambda: self.connect(addr))
+            else:
+                self.connect(addr)
 
     def set_collector(self, collector):
         self.collector = collector
@@ -52,17 +64,37 @@ class P2PConnection(Dispatcher):
         return None
 
     def flushed(self):
-        return (self.ac_out_buffer == '') and self.producer_fifo.is_empty()
+        return (self.ac_out_offset == len(self.ac_out_buffer)) and \
+                self.producer_fifo.is_empty()
+
+    def pause_reading(self):
+        """ Stop reading from the socket until resume_reading has been
+            called as many times as this, leaving TCP to push back on
+            the sender """
+        self.read_paused += 1
+
+    def resume_reading(self):
+        if self.read_paused > 0:
+            self.read_paused -= 1
+
+    def recv(self, buffer_size):
+        data = Dispatcher.recv(self, buffer_size)
+        if data and self.download_limiter is not None:
+            self.download_limiter.received(self, len(data))
+        return data
 
     ## asynchat.async_chat methods ##
 
+    def readable (self):
+        return not self.read_paused and Dispatcher.readable(self)
+
     def writable (self):
         "predicate for inclusion in the writable for select()"
         # return len(self.ac_out_buffer) or len(self.producer_fifo) or
         #        (not self.connected) or self.want_write
         # this is about twice as fast, though not as clear.
         return not (
-                (self.ac_out_buffer == '') and
+                (self.ac_out_offset == len(self.ac_out_buffer)) and
                 self.producer_fifo.is_empty() and
                 self.connected and
                 not self.want_write
@@ -97,28 +129,30 @@ class P2PConnection(Dispatcher):
     ## asyncore.dispatcher methods ##
 
     def connect(self, addr):
-        sslsock = SSL.Connection(self.ssl_ctx)
-        checker = PostConnectionChecker()
-        sslsock.set_post_connection_check_callback(checker)
-        # TODO: Determine good timeout interval
-        sslsock.set_socket_read_timeout(SSL.timeout(10))
-        sslsock.set_socket_write_timeout(SSL.timeout(10))
-        sslsock.setblocking(1)
+        """ Start a non-blocking connect and TLS handshake to addr.
+            connect_cb is called from the event loop once it completes,
+            with self.connected indicating whether it succeeded. """
         self.addr = addr
-        try:
-            sslsock.connect(addr)
-        except (SSL.SSLError, SSL.Checker.SSLVerificationError, socket.error), e:
-            # will result in connect_cb being called with
-            # self.connected = False
-            log.info("Problem connecting to %s:%d. %s" % (addr[0], addr[1], e))
-        else:
-            # All socket operations after connect() are non-blocking
-            # and handled with asyncore
-            sslsock.setblocking(0)
+        self.connect_started = bttime()
+        TLSConnector(addr, self.ssl_ctx, self._connect_done,
+                     self.schedule, self.connect_timeout)
+
+    def _connect_done(self, sslsock, err):
+        latency = None
+        if err is None:
             self.set_socket(sslsock) # registers with asyncore
             self.connected = True # connect_cb success
-        if self.schedule is not None:
-            # Join back into the main thread
+            latency = bttime() - self.connect_started
+        else:
+            # will result in connect_cb being called with
+            # self.connected = False
+            log.info("Problem connecting to %s:%d. %s" % \
+                        (self.addr[0], self.addr[1], err))
+        if self.connect_limiter is not None:
+            self.connect_limiter.release(latency)
+        if err is not None and self.schedule is not None:
+            # Failures can be reported from within __init__, so give
+            # the creator a chance to finish setting up first.
             self.schedule(0, self.do_connect_cb)
         else:
             self.do_connect_cb()
@@ -142,6 +176,8 @@ class P2PConnection(Dispatcher):
         self.close()
 
     def close(self):
+        if self.download_limiter is not None:
+            self.download_limiter.remove(self)
         if self.collector:
             self.collector.socket_closed()
         self.socket.set_shutdown(SSL.m2.SSL_SENT_SHUTDOWN|SSL.m2.SSL_RECEIVED_SHUTDOWN)
@@ -151,6 +187,159 @@ class P2PConnection(Dispatcher):
         self.connected = False
 
 
+class TLSConnector(asyncore.dispatcher):
+    """ Drives an outbound TCP connect and TLS handshake from the event
+        loop without blocking. Once the handshake (and post connection
+        check) completes, or fails, or times out, the SSL connection is
+        handed to done_cb(sslsock, error) and this object unregisters
+        itself so the caller can take over the descriptor. """
+    def __init__(self, addr, ssl_ctx, done_cb, schedule=None, timeout=10):
+        asyncore.dispatcher.__init__(self)
+        self.addr = addr
+        self.done_cb = done_cb
+        self.handshaking = False
+        self.want_read = False
+        self.timer = None
+        raw = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        raw.setblocking(0)
+        # Created over a non-blocking socket so that M2Crypto never
+        # waits inside connect_ssl()
+        self.sslsock = SSL.Connection(ssl_ctx, raw)
+        self.sslsock.set_post_connection_check_callback(PostConnectionChecker())
+        self.set_socket(self.sslsock)
+        if schedule is not None and timeout:
+            self.timer = schedule(timeout, self._timed_out)
+        err = raw.connect_ex(addr)
+        if err not in (0, EINPROGRESS, EWOULDBLOCK, EALREADY):
+            self._finish(socket.error(err, os.strerror(err)))
+
+    def readable(self):
+        return self.handshaking and self.want_read
+
+    def writable(self):
+        # Writability signals completion of the TCP connect
+        return not (self.handshaking and self.want_read)
+
+    def handle_read_event(self):
+        self._step()
+
+    def handle_write_event(self):
+        self._step()
+
+    def handle_expt_event(self):
+        self._step()
+
+    def handle_close(self):
+        self._finish(socket.error("Connection closed during handshake"))
+
+    def handle_error(self):
+        self._finish(sys.exc_info()[1])
+
+    def _step(self):
+        if self.done_cb is None:
+            return
+        try:
+            if not self.handshaking:
+                err = self.sslsock.socket.getsockopt(socket.SOL_SOCKET,
+                                                     socket.SO_ERROR)
+                if err != 0:
+                    raise socket.error(err, os.strerror(err))
+                self.sslsock.addr = self.addr
+                self.sslsock.setup_ssl()
+                self.sslsock.set_connect_state()
+                self.handshaking = True
+            r = self.sslsock.connect_ssl()
+            if r == 1:
+                check = getattr(self.sslsock, 'postConnectionCheck', None)
+                if check is not None and \
+                        not check(self.sslsock.get_peer_cert(), self.addr[0]):
+                    raise SSL.Checker.SSLVerificationError(
+                                'post connection check failed')
+                self._finish(None)
+            elif r == 0:
+                raise SSL.SSLError("Handshake shut down by peer")
+            else:
+                self.want_read = self._wants_read()
+        except (SSL.SSLError, SSL.Checker.SSLVerificationError, socket.error), e:
+            self._finish(e)
+
+    def _wants_read(self):
+        try:
+            err = SSL.m2.ssl_get_error(self.sslsock.ssl, -1)
+            return err != SSL.m2.ssl_error_want_write
+        except AttributeError:
+            return False
+
+    def _timed_out(self):
+        self.timer = None
+        self._finish(socket.timeout("Timed out connecting"))
+
+    def _finish(self, err):
+        if self.done_cb is None:
+            return
+        cb, self.done_cb = self.done_cb, None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.del_channel()
+        sslsock, self.sslsock = self.sslsock, None
+        if err is not None:
+            try:
+                sslsock.close()
+            except Exception:
+                sslsock.socket.close()
+            cb(None, err)
+        else:
+            # All socket operations after connect() are non-blocking
+            # and handled with asyncore
+            sslsock.setblocking(0)
+            cb(sslsock, None)
+
+
+class ConnectLimiter(object):
+    """ Caps the number of outbound connects in progress at once and
+        measures how long successful connects take """
+    def __init__(self, max_connects=0):
+        self.max_connects = max_connects
+        self.active = 0
+        self.waiting = deque()
+        self.latency = 0.0
+        self.completed = 0
+        self.failed = 0
+
+    def _has_room(self):
+        return self.max_connects <= 0 or self.active < self.max_connects
+
+    def request(self, start):
+        """ Call start() now, or once an in-progress connect finishes """
+        if self._has_room():
+            self.active += 1
+            start()
+        else:
+            self.waiting.append(start)
+
+    def release(self, latency=None):
+        """ Called when a connect finishes. latency is None on failure """
+        self.active -= 1
+        if latency is None:
+            self.failed += 1
+        else:
+            self.completed += 1
+            if self.completed == 1:
+                self.latency = latency
+            else:
+                self.latency = .8 * self.latency + .2 * latency
+        while self.waiting and self._has_room():
+            self.active += 1
+            self.waiting.popleft()()
+
+    def get_stats(self):
+        return {'connectLatency' : self.latency,
+                'connectsActive' : self.active,
+                'connectsWaiting' : len(self.waiting),
+                'connectsFailed' : self.failed}
+
+
 class PostConnectionChecker(SSL.Checker.Checker):
     def __call__(self, peercert, host=None):
         # Ignore host parameter
@@ -22,67 +22,234 @@
 # on the same NeighborLink. PartialMessageQueue also holds the id
 # of the stream which sent each message in the queue, so that the
 # stream can be notified when the message is dequeued for sending.
+#
+# Each stream has its own deque of messages and the streams which have
+# something queued are kept in a round-robin ready list, so queueing and
+# dequeueing cost O(1) regardless of how many streams share the link.
+# A message which has to be split is never copied; PARTIAL chunks are
+# memoryview slices of the original message.
+#
+# The queue can be bounded per stream and per link. Once either limit is
+# exceeded full_cb(sid) is called for the stream which queued the message,
+# and drained_cb(sid) is called once both levels have fallen back to half
+# of their limits, so that the producers feeding the stream can be paused.
+# Messages are never dropped; the limits are advisory.
+#
+# Streams on a link which does credit based flow control may only start
+# sending an ENCRYPTED message while they hold credit granted by the
+# remote end of the stream. A stream without credit is taken off the
+# ready list until add_credit is called for it.
+#
+# Small control messages (TCODE, CONFIRM and the endpoint messages other
+# than PIECE) can be put in a separate control lane, which NeighborLink
+# sends ahead of all stream data and outside of the RateLimiter. A message
+# only enters the lane while its stream has nothing in the regular queue,
+# since messages of one stream must not be reordered (ENCRYPTED messages
+# can only be decrypted in the order they were encrypted). The lane holds
+# at most max_control_bytes; beyond that control messages are queued like
+# any other message.
+#
+# Relayers forward the PARTIAL chunks they receive without reassembling
+# them. Such a chunk is queued as a message of its own and is always sent
+# whole, since a PARTIAL can't be split again.
 
-from Anomos.Protocol import tobinary, PARTIAL
+from collections import deque, OrderedDict
 
-PARTIAL_FMT_LEN = len(PARTIAL+tobinary(0))
+from Anomos.Protocol import ENCRYPTED, PARTIAL, codec
 
-class PartialMessageQueue(object):
-    #TODO: Give this a maximum length.
+PARTIAL_FMT_LEN = codec.PARTIAL_HEADER_LEN
+
+def _credit_cost(msg):
+    """ Credit is counted in bytes of ENCRYPTED messages, a relayed
+        PARTIAL chunk (which only ever carries part of one) costs its
+        payload """
+    if msg[0] == PARTIAL:
+        return len(msg) - PARTIAL_FMT_LEN
+    return len(msg)
+
+class _StreamQueue(object):
+    __slots__ = ['msgs', 'offset', 'size']
     def __init__(self):
+        self.msgs = deque()
+        self.offset = 0 # Bytes of msgs[0] which have already been sent
+        self.size = 0 # Unsent bytes in msgs
+
+class PartialMessageQueue(object):
+    def __init__(self, max_stream_bytes=0, max_link_bytes=0,
+                 full_cb=None, drained_cb=None, max_control_bytes=2**16):
         self._deeplen = 0
-        self.msgs = {}
-    def queue_message(self, sid, message):
+        self.queues = {} # {StreamID : _StreamQueue}
+        # Streams with queued data, in the order they should be served
+        self.ready = OrderedDict()
+        self.max_stream_bytes = max_stream_bytes
+        self.max_link_bytes = max_link_bytes
+        self.full_cb = full_cb
+        self.drained_cb = drained_cb
+        self.blocked = set() # Streams whose producers have been paused
+        self.credit = {} # {StreamID : bytes} for credit limited streams
+        self.stalled = set() # Streams waiting for credit
+        self.control = deque() # [(StreamID, message), ...]
+        self.control_bytes = 0
+        self.max_control_bytes = max_control_bytes
+
+    def queue_message(self, sid, message, control=False):
         """ Add a message to the message queue 
             @param streamid: Stream ID of message sender
             @param message: Message to be sent
+            @param control: Whether message may use the control lane
             @type streamid: int
             @type message: string"""
+        if control and sid not in self.queues and \
+                self.control_bytes + len(message) <= self.max_control_bytes:
+            self.control.append((sid, message))
+            self.control_bytes += len(message)
+            if sid in self.credit and message[0] == ENCRYPTED:
+                # Not held back, but still paid for
+                self.credit[sid] -= len(message)
+            return
+        q = self.queues.get(sid)
+        if q is None:
+            q = self.queues[sid] = _StreamQueue()
+            self.ready[sid] = None
+        q.msgs.append(message)
+        q.size += len(message)
         self._deeplen += len(message)
-        self.msgs.setdefault(sid, []).append(message)
-    def is_partial(self, message):
-        return message[0] == PARTIAL
-    def mk_partial(self, message):
-        fmt = PARTIAL + tobinary(len(message))
-        self._deeplen += PARTIAL_FMT_LEN
-        return fmt + message
+        if sid not in self.blocked and \
+                (self.max_stream_bytes and q.size > self.max_stream_bytes or
+                 self.max_link_bytes and self._deeplen > self.max_link_bytes):
+            self.blocked.add(sid)
+            if self.full_cb is not None:
+                self.full_cb(sid)
+
     def dequeue_partial(self, sid, numbytes):
-        """ Dequeue numbytes from the message queue. Return
-            the stream IDs associated with the messages which
-            were dequeued in full and the message to be sent.
+        """ Dequeue up to numbytes (PARTIAL headers included) of the
+            messages queued by stream sid. Messages which fit are
+            returned whole, the rest is returned as PARTIAL chunks.
             @param numbytes: Number of bytes to be sent
             @type numbytes: int
-            @return: ([Stream IDs...], "Message")"""
-        if self._deeplen == 0 or not self.msgs.has_key(sid):
-            return ''
-        i, r = self._pindex(sid, numbytes)
-        deq = self.msgs[sid][:i]
-        # If numbytes fell within a message, not on a message
-        # boundary, then add the remaining bytes (r) to the
-        # dequeued portion.
-        if r > PARTIAL_FMT_LEN and i < len(self.msgs):
-            if not self.is_partial(self.msgs[i]):
-                self.msgs[sid][i] = self.mk_partial(self.msgs[sid][i])
-            deq.append(self.msgs[sid][i][:r])
-            self.msgs[sid][i] = self.mk_partial(self.msgs[sid][i][r:])
-        # Delete the sent messages/informed stream ids
-        del self.msgs[sid][:i]
-        self._deeplen -= sum([len(i) for i in deq])
-        return deq
+            @return: [(message parts...), ...] where the parts of each
+                     message are strings or memoryviews"""
+        q = self.queues.get(sid)
+        if q is None or sid in self.stalled:
+            return []
+        out = []
+        sent = 0
+        limited = sid in self.credit
+        while q.msgs and numbytes > 0:
+            msg = q.msgs[0]
+            left = len(msg) - q.offset
+            if q.offset == 0:
+                # Relayed PARTIAL chunks are forwarded as they are
+                whole = left <= numbytes or msg[0] == PARTIAL
+                if not whole and numbytes <= PARTIAL_FMT_LEN:
+                    break
+                if limited and msg[0] in (ENCRYPTED, PARTIAL):
+                    if self.credit[sid] <= 0:
+                        self.stalled.add(sid)
+                        break
+                    # Messages are never split for credit, so the balance
+                    # may go negative by up to one message
+                    self.credit[sid] -= _credit_cost(msg)
+                if whole:
+                    q.msgs.popleft()
+                    out.append((msg,))
+                    numbytes -= left
+                    sent += left
+                    continue
+            n = min(left, numbytes - PARTIAL_FMT_LEN)
+            if n <= 0:
+                break
+            chunk = memoryview(msg)[q.offset:q.offset+n]
+            out.append((codec.partial_header(left), chunk))
+            numbytes -= n + PARTIAL_FMT_LEN
+            sent += n
+            if n == left:
+                q.msgs.popleft()
+                q.offset = 0
+            else:
+                q.offset += n
+                break
+        q.size -= sent
+        self._deeplen -= sent
+        del self.ready[sid]
+        if not q.msgs:
+            del self.queues[sid]
+        elif sid not in self.stalled:
+            # Move to the back of the round-robin
+            self.ready[sid] = None
+        if self.blocked:
+            self._check_drained()
+        return out
+
+    def _check_drained(self):
+        if self.max_link_bytes and self._deeplen > self.max_link_bytes / 2:
+            return
+        for sid in list(self.blocked):
+            q = self.queues.get(sid)
+            if q is None or not self.max_stream_bytes or \
+                    q.size <= self.max_stream_bytes / 2:
+                self.blocked.discard(sid)
+                if self.drained_cb is not None:
+                    self.drained_cb(sid)
+
     def remove_by_sid(self, sid):
         """ Removes all messages queued by the stream given by sid """
-        if not self.msgs.has_key(sid):
-            return
-        del self.msgs[sid]
-    def _pindex(self, sid, p):
-        # Returns index of p'th byte in message queue
-        # (Treating the queue as an irregular 2d array)
-        if len(self.msgs[sid]) <= p:
-            return (len(self.msgs[sid]), 0)
-        i = t = 0
-        while i < len(self.msgs[sid]) and t + len(self.msgs[sid][i]) <= p:
-            t += len(self.msgs[sid][i])
-            i += 1
-        return (i, p-t)
+        q = self.queues.pop(sid, None)
+        if q is not None:
+            self._deeplen -= q.size
+            self.ready.pop(sid, None)
+        self.credit.pop(sid, None)
+        self.stalled.discard(sid)
+        if self.control_bytes:
+            self.control = deque([c for c in self.control if c[0] != sid])
+            self.control_bytes = sum([len(c[1]) for c in self.control])
+        if sid in self.blocked:
+            # Let the producer go, there's nothing left to wait for
+            self.blocked.discard(sid)
+            if self.drained_cb is not None:
+                self.drained_cb(sid)
+        if self.blocked:
+            self._check_drained()
+
+    def dequeue_control(self):
+        """ @return: [(StreamID, message), ...] for every message in
+                     the control lane, oldest first """
+        msgs = list(self.control)
+        self.control.clear()
+        self.control_bytes = 0
+        return msgs
+
+    def limit_credit(self, sid):
+        """ Make stream sid wait for credit before sending ENCRYPTED
+            messages """
+        self.credit.setdefault(sid, 0)
+
+    def add_credit(self, sid, numbytes):
+        """ @return: True if stream sid was waiting for credit and
+                     may now send again """
+        if sid not in self.credit:
+            return False
+        self.credit[sid] += numbytes
+        if sid in self.stalled and self.credit[sid] > 0:
+            self.stalled.discard(sid)
+            if sid in self.queues:
+                self.ready[sid] = None
+            return True
+        return False
+
+    def has_queued(self, sid):
+        return sid in self.queues
+
+    def queued_bytes(self, sid):
+        q = self.queues.get(sid)
+        if q is None:
+            return 0
+        return q.size
+
+    def ready_streams(self):
+        """ @return: IDs of the streams with queued data, in
+                     round-robin order """
+        return self.ready.keys()
+
     def __len__(self):
         return self._deeplen
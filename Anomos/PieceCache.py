@@ -0,0 +1,83 @@
+# PieceCache.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Whole pieces recently read for uploading, shared by all torrents.
+#
+# Peers request a piece a slice at a time, and popular pieces are wanted
+# by many of them, so StorageWrapper.get_piece reads the whole piece the
+# first time any part of it is requested and serves the rest from here.
+# Pieces are only cached once they've passed their hash check, after
+# which their data never changes.
+
+from collections import OrderedDict
+
+class PieceCache(object):
+    """ Least recently used pieces, bounded by their total size """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.pieces = OrderedDict() # {(infohash, index) : data}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def set_size(self, maxsize):
+        self.maxsize = maxsize
+        self._evict(0)
+
+    def fits(self, length):
+        """ Whether a piece of length bytes can be cached at all """
+        return length <= self.maxsize
+
+    def get(self, infohash, index):
+        """ @return: The piece's data, None if it isn't cached """
+        key = (infohash, index)
+        data = self.pieces.pop(key, None)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pieces[key] = data # Most recently used goes last
+        return data
+
+    def put(self, infohash, index, data):
+        if not self.fits(len(data)):
+            return
+        key = (infohash, index)
+        old = self.pieces.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._evict(len(data))
+        self.pieces[key] = data
+        self.size += len(data)
+
+    def _evict(self, room):
+        while self.pieces and self.size + room > self.maxsize:
+            key, data = self.pieces.popitem(last=False)
+            self.size -= len(data)
+
+    def remove_torrent(self, infohash):
+        for key in [k for k in self.pieces if k[0] == infohash]:
+            self.size -= len(self.pieces.pop(key))
+
+    def get_stats(self):
+        requests = self.hits + self.misses
+        hitrate = 0
+        if requests:
+            hitrate = float(self.hits) / requests
+        return {'pieceCacheHits' : self.hits,
+                'pieceCacheMisses' : self.misses,
+                'pieceCacheHitRate' : hitrate,
+                'pieceCacheSize' : self.size}
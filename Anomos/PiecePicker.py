@@ -29,6 +29,7 @@ class PiecePicker(object):
         self.started = []
         self.seedstarted = []
         self.numgot = 0
+        self.seeds = 0 # Peers which have every piece, not in numinterests
         self.scrambled = range(numpieces)
         shuffle(self.scrambled)
 
@@ -46,6 +47,14 @@ class PiecePicker(object):
             self.interests.append([])
         self._shift_over(piece, self.interests[numint], self.interests[numint + 1])
 
+    def got_seed(self):
+        # A seed adds one to every piece's count, which doesn't change
+        # their order
+        self.seeds += 1
+
+    def lost_seed(self):
+        self.seeds -= 1
+
     def lost_have(self, piece):
         numint = self.numinterests[piece]
         self.crosscount[numint + self.have[piece]] -= 1
@@ -118,7 +127,12 @@ class PiecePicker(object):
                 if havefunc(i):
                     return i
             return None
-        for i in xrange(1, min(bestnum, len(self.interests))):
+        # Pieces nobody but seeds has are at level 0
+        if self.seeds:
+            first = 0
+        else:
+            first = 1
+        for i in xrange(first, min(bestnum, len(self.interests))):
             for j in self.interests[i]:
                 if havefunc(j):
                     return j
@@ -0,0 +1,169 @@
+# Poller.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pollers wait for socket events on behalf of EventHandler.loop. All of
+# them honour the asyncore.dispatcher readable()/writable() predicates,
+# which are re-evaluated on every iteration, so objects like P2PConnection
+# which report themselves writable while SSL wants a write keep working
+# no matter which backend is in use.
+
+import asyncore
+import select
+import weakref
+
+from errno import ENOENT, EBADF, EINTR, EEXIST
+from Anomos import LOG as log
+
+# epoll and poll take their timeout as a C int of milliseconds
+MAX_TIMEOUT = 2 ** 31 / 1000 - 1
+
+class SelectPoller(object):
+    name = 'select'
+    def poll(self, timeout, map):
+        asyncore.poll(timeout, map)
+
+class PollPoller(object):
+    name = 'poll'
+    def poll(self, timeout, map):
+        asyncore.poll2(min(timeout, MAX_TIMEOUT), map)
+
+# EpollPollers in use, which channel_closing tells about descriptors
+# which are about to be closed
+_epollers = weakref.WeakSet()
+
+def channel_closing(fd, obj):
+    """ Called by Dispatcher.del_channel while fd is still open. Other
+        dispatchers are caught by the check for reused descriptors in
+        EpollPoller.poll. """
+    for p in list(_epollers):
+        p.forget(fd, obj)
+
+class EpollPoller(object):
+    """ Level-triggered epoll backend. Descriptors stay registered between
+        iterations and are only modified when the event mask of their
+        dispatcher changes.
+
+        The kernel drops a descriptor from the epoll set when it's closed,
+        and its number may be reused by another socket right away, so
+        registrations are remembered together with their dispatcher and
+        are dropped by channel_closing before the socket is closed. """
+    name = 'epoll'
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.registered = {} # {fd : (dispatcher, event mask)}
+        _epollers.add(self)
+
+    def _flags(self, obj):
+        flags = 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # accepting sockets should not be writable
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        if flags:
+            flags |= select.EPOLLERR | select.EPOLLHUP
+        return flags
+
+    def _update(self, fd, obj, flags):
+        old = self.registered.get(fd)
+        if old is not None and old[0] is not obj:
+            # The fd was closed and reused by another dispatcher
+            self._forget(fd)
+            old = None
+        if old is not None and old[1] == flags:
+            return
+        try:
+            if old is None:
+                try:
+                    self.epoll.register(fd, flags)
+                except IOError, e:
+                    # Still registered if the old socket wasn't closed
+                    # through channel_closing
+                    if e.errno != EEXIST:
+                        raise
+                    self.epoll.modify(fd, flags)
+            else:
+                try:
+                    self.epoll.modify(fd, flags)
+                except IOError, e:
+                    # The kernel drops closed descriptors on its own, so
+                    # a reused fd number has to be registered again.
+                    if e.errno != ENOENT:
+                        raise
+                    self.epoll.register(fd, flags)
+        except (IOError, OSError), e:
+            log.info("Could not register fd %d with epoll: %s" % (fd, e))
+            self.registered.pop(fd, None)
+            return
+        self.registered[fd] = (obj, flags)
+
+    def forget(self, fd, obj):
+        """ Called by channel_closing while fd is still open """
+        old = self.registered.get(fd)
+        if old is not None and old[0] is obj:
+            self._forget(fd)
+
+    def _forget(self, fd):
+        del self.registered[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError), e:
+            if e.errno not in (ENOENT, EBADF):
+                raise
+
+    def poll(self, timeout, map):
+        for fd in [fd for fd in self.registered if fd not in map]:
+            self._forget(fd)
+        # readable() and writable() depend on state which changes without
+        # telling us (SSL wanting a write, paused reads, rate limits), so
+        # they're asked every time. Only changed masks cost a syscall.
+        for fd, obj in map.items():
+            self._update(fd, obj, self._flags(obj))
+        if timeout is None or timeout > MAX_TIMEOUT:
+            timeout = -1
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != EINTR:
+                raise
+            return
+        for fd, flags in events:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            asyncore.readwrite(obj, flags)
+
+POLLERS = {'select' : SelectPoller,
+           'poll' : PollPoller,
+           'epoll' : EpollPoller}
+
+def get_poller(name='auto'):
+    """ Return a poller instance for the named backend. 'auto' picks the
+        most scalable backend available on this platform. """
+    if name not in POLLERS and name != 'auto':
+        log.warning("Unknown poller '%s', choosing one automatically" % name)
+        name = 'auto'
+    if name == 'auto':
+        if hasattr(select, 'epoll'):
+            name = 'epoll'
+        elif hasattr(select, 'poll'):
+            name = 'poll'
+        else:
+            name = 'select'
+    if name == 'epoll' and not hasattr(select, 'epoll') or \
+       name == 'poll' and not hasattr(select, 'poll'):
+        log.warning("%s is not available on this platform, using select" % name)
+        name = 'select'
+    return POLLERS[name]()
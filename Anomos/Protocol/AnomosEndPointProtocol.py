@@ -15,11 +15,16 @@
 
 # Written by John Schanck
 
+import hashlib
+import hmac
+
 from Anomos.Protocol import CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, \
                             HAVE, BITFIELD, REQUEST, PIECE, CANCEL, \
                             TCODE, CONFIRM, ENCRYPTED, BREAK, PARTIAL, \
-                            ACKBREAK
-from Anomos.Protocol import tobinary, toint, AnomosProtocol
+                            ACKBREAK, CREDIT, REBIND, REBIND_ACK, HAVES, \
+                            HAVE_ALL, HAVE_NONE, REJECT, ALLOWED_FAST, \
+                            SLICE_SIZE, E2E_EXTENSIONS
+from Anomos.Protocol import AnomosProtocol, codec
 from Anomos.bitfield import Bitfield
 from Anomos import log_on_call, LOG as log
 
@@ -33,15 +38,24 @@ class AnomosEndPointProtocol(AnomosProtocol):
                             INTERESTED: self.got_interested,\
                             NOT_INTERESTED: self.got_not_interested,\
                             HAVE: self.got_have,\
+                            HAVES: self.got_haves,\
+                            HAVE_ALL: self.got_have_all,\
+                            HAVE_NONE: self.got_have_none,\
                             BITFIELD: self.got_bitfield,\
                             REQUEST: self.got_request,\
                             PIECE: self.got_piece,\
                             CANCEL: self.got_cancel,\
+                            REJECT: self.got_reject,\
+                            ALLOWED_FAST: self.got_allowed_fast,\
+                            SLICE_SIZE: self.got_slice_size,\
                             CONFIRM: self.got_confirm, \
                             ENCRYPTED: self.got_encrypted, \
                             BREAK: self.got_break, \
                             PARTIAL: self.got_partial, \
-                            ACKBREAK: self.got_ack_break})
+                            ACKBREAK: self.got_ack_break, \
+                            CREDIT: self.got_credit, \
+                            REBIND: self.got_rebind, \
+                            REBIND_ACK: self.got_rebind_ack})
     def invalid_message(self, t):
         log.warning("Invalid message of type %02x on %s. Closing stream."% \
                     (ord(t), self.uniq_id()))
@@ -49,8 +63,13 @@ class AnomosEndPointProtocol(AnomosProtocol):
     def transfer_ctl_msg(self, type, message=""):
         """ Send method for file transfer messages.
             ie. CHOKE, INTERESTED, PIECE """
-        payload = ENCRYPTED + self.e2e_key.encrypt(type + message)
-        self.neighbor.queue_message(self.stream_id, payload)
+        self.send_encrypted(type + message)
+    def send_encrypted(self, message):
+        """ Encrypt an already encoded message and queue it. Everything
+            but PIECE may use the neighbor's control lane. """
+        payload = ENCRYPTED + self.e2e_key.encrypt(message)
+        self.neighbor.queue_message(self.stream_id, payload,
+                                    message[0] != PIECE)
         #if self.should_queue():
         #    self.ratelimiter.queue(self)
 
@@ -61,7 +80,10 @@ class AnomosEndPointProtocol(AnomosProtocol):
     def got_encrypted(self, message):
         if self.e2e_key is not None:
             m = self.e2e_key.decrypt(message[1:])
-            self.got_message(m)
+            if self.torrent is not None or m[:1] in (REBIND, REBIND_ACK):
+                self.got_message(m)
+            # else: Parked circuit, the other end may not know yet
+            self.consumed(len(message))
         else:
             raise RuntimeError("Received encrypted data before we were ready")
     def got_break(self):
@@ -76,12 +98,30 @@ class AnomosEndPointProtocol(AnomosProtocol):
                 self.shutdown()
             self.neighbor.end_stream(self.stream_id)
             self.neighbor = None
+    def rebind_mac(self, message):
+        """ Rebinding messages are authenticated with our end to end key
+            so that relays can't forge them or alter the infohash """
+        return hmac.new(self.e2e_key.key, message, hashlib.sha1).digest()
+    def got_rebind(self, message):
+        infohash, mac = codec.decode_rebind(message)
+        if mac != self.rebind_mac(REBIND + infohash):
+            self.fatal_error("Bad MAC on REBIND")
+            return
+        self.rebind_requested(infohash)
+    def got_rebind_ack(self, message):
+        accepted, infohash, mac = codec.decode_rebind_ack(message)
+        if mac != self.rebind_mac(codec.rebind_ack(accepted, infohash, '')):
+            self.fatal_error("Bad MAC on REBIND_ACK")
+            return
+        self.rebind_answered(accepted, infohash)
+    def got_credit(self, message):
+        self.neighbor.add_credit(self.stream_id, codec.decode_credit(message))
     def got_partial(self, message):
-        p_remain = toint(message[1:5])
-        payload = message[5:]
+        p_remain, payload = codec.decode_partial(message)
         self.partial_recv += payload
         if len(self.partial_recv) > self.neighbor.config['max_message_length']:
-            log.error("Received message longer than max length, %d"%l)
+            log.error("Received message longer than max length, %d" % \
+                        len(self.partial_recv))
             return
         if len(payload) == p_remain:
             self.got_message(self.partial_recv)
@@ -99,12 +139,28 @@ class AnomosEndPointProtocol(AnomosProtocol):
         if self.upload:
             self.upload.got_not_interested()
     def got_have(self, message):
-        i = toint(message[1:])
+        i = codec.decode_have(message)
         if i >= self.torrent.numpieces:
             log.error("Piece index out of range")
             self.fatal_error()
             return
         self.download.got_have(i)
+    def got_haves(self, message):
+        indices = codec.decode_haves(message)
+        for i in indices:
+            if i >= self.torrent.numpieces:
+                self.fatal_error("Piece index out of range")
+                return
+        for i in indices:
+            if self.closed:
+                # Closed by got_have once the other end had everything
+                return
+            self.download.got_have(i)
+    def got_have_all(self):
+        self.download.got_have_all()
+    def got_have_none(self):
+        # Nothing to do, we assume peers have nothing until told otherwise
+        pass
     def got_bitfield(self, message):
         try:
             b = Bitfield(self.torrent.numpieces, message[1:])
@@ -113,27 +169,44 @@ class AnomosEndPointProtocol(AnomosProtocol):
             return
         self.download.got_have_bitfield(b)
     def got_request(self, message):
-        i = toint(message[1:5])
+        i, begin, length = codec.decode_request(message)
         if i >= self.torrent.numpieces:
             self.fatal_error("Piece index out of range")
             return
         if self.upload:
-            self.upload.got_request(i, toint(message[5:9]), toint(message[9:]))
+            self.upload.got_request(i, begin, length)
     def got_cancel(self, message):
-        i = toint(message[1:5])
+        i, begin, length = codec.decode_request(message)
+        if begin == codec.EXTENSIONS_BEGIN:
+            self.extensions_announced(length)
+            return
         if i >= self.torrent.numpieces:
             self.fatal_error("Piece index out of range")
             return
         if self.upload:
-            self.upload.got_cancel(i, toint(message[5:9]), toint(message[9:]))
+            self.upload.got_cancel(i, begin, length)
+    def got_reject(self, message):
+        i, begin, length = codec.decode_request(message)
+        if i >= self.torrent.numpieces:
+            self.fatal_error("Piece index out of range")
+            return
+        self.download.got_reject(i, begin, length)
+    def got_allowed_fast(self, message):
+        i = codec.decode_have(message)
+        if i >= self.torrent.numpieces:
+            self.fatal_error("Piece index out of range")
+            return
+        self.download.got_allowed_fast(i)
+    def got_slice_size(self, message):
+        self.download.got_slice_size(codec.decode_slice_size(message))
     def got_piece(self, message):
-        i = toint(message[1:5])
+        i, begin, piece = codec.decode_piece(message)
         if i >= self.torrent.numpieces:
             self.fatal_error("Piece index out of range")
             return
-        if self.download.got_piece(i, toint(message[5:9]), message[9:]):
+        if self.download.got_piece(i, begin, piece):
             for ep in self.torrent.active_streams:
-                ep.send_have(i)
+                ep.queue_have(i)
 
     # Message sending calls #
     def send_break(self):
@@ -143,6 +216,14 @@ class AnomosEndPointProtocol(AnomosProtocol):
         self.network_ctl_msg(ACKBREAK)
     def send_confirm(self):
         self.network_ctl_msg(CONFIRM)
+    def send_credit(self, numbytes):
+        self.network_ctl_msg(CREDIT, codec.uint32(numbytes))
+    def send_rebind(self, infohash):
+        self.send_encrypted(codec.rebind(infohash,
+                                         self.rebind_mac(REBIND + infohash)))
+    def send_rebind_ack(self, accepted, infohash):
+        mac = self.rebind_mac(codec.rebind_ack(accepted, infohash, ''))
+        self.send_encrypted(codec.rebind_ack(accepted, infohash, mac))
     def send_interested(self):
         self.transfer_ctl_msg(INTERESTED)
     def send_not_interested(self):
@@ -156,17 +237,28 @@ class AnomosEndPointProtocol(AnomosProtocol):
         self.transfer_ctl_msg(UNCHOKE)
         self.choke_sent = False
     def send_request(self, index, begin, length):
-        self.transfer_ctl_msg(REQUEST, tobinary(index) +
-            tobinary(begin) + tobinary(length))
+        self.send_encrypted(codec.request(index, begin, length))
     def send_cancel(self, index, begin, length):
-        self.transfer_ctl_msg(CANCEL, tobinary(index) +
-            tobinary(begin) + tobinary(length))
+        self.send_encrypted(codec.cancel(index, begin, length))
+    def send_extensions(self):
+        self.send_encrypted(codec.extensions(E2E_EXTENSIONS))
+    def send_reject(self, index, begin, length):
+        self.send_encrypted(codec.reject(index, begin, length))
     def send_bitfield(self, bitfield):
         self.transfer_ctl_msg(BITFIELD, bitfield)
+    def send_have_all(self):
+        self.transfer_ctl_msg(HAVE_ALL)
+    def send_have_none(self):
+        self.transfer_ctl_msg(HAVE_NONE)
+    def send_slice_size(self, length):
+        self.send_encrypted(codec.slice_size(length))
+    def send_allowed_fast(self, index):
+        self.send_encrypted(codec.allowed_fast(index))
     def send_have(self, index):
-        self.transfer_ctl_msg(HAVE, tobinary(index))
+        self.send_encrypted(codec.have(index))
+    def send_haves(self, indices):
+        self.send_encrypted(codec.haves(indices))
     def send_tracking_code(self, trackcode):
         self.network_ctl_msg(TCODE, trackcode)
     def send_piece(self, index, begin, piece):
-        msg = "".join([tobinary(index), tobinary(begin), piece])
-        self.transfer_ctl_msg(PIECE, msg)
+        self.send_encrypted(codec.piece(index, begin, piece))
@@ -17,7 +17,8 @@
 
 import Anomos.Crypto
 
-from Anomos.Protocol import PARTIAL, TCODE, tobinary, toint, AnomosProtocol
+from Anomos.Protocol import PARTIAL, TCODE, CREDIT, PING, PONG, \
+                            LINK_STREAM_ID, AnomosProtocol, codec
 from Anomos.TCReader import TCReader
 from Anomos import LOG as log
 
@@ -27,18 +28,19 @@ class AnomosNeighborProtocol(AnomosProtocol):
         AnomosProtocol.__init__(self)
 
         self.msgmap.update({PARTIAL:self.got_partial,
-                            TCODE: self.got_tcode})
+                            TCODE: self.got_tcode,
+                            CREDIT: self.got_credit,
+                            PING: self.got_ping,
+                            PONG: self.got_pong})
 
     def format_message(self, stream_id, message):
-        return tobinary(stream_id)[2:] + \
-               tobinary(len(message)) + message
+        return codec.frame(stream_id, message)
     def invalid_message(self, t):
         log.warning("Invalid message of type %02x on %s. Closing neighbor."% \
                     (ord(t), self.uniq_id()))
         self.socket.close()
     def got_partial(self, message):
-        p_remain = toint(message[1:5])
-        payload = message[5:]
+        p_remain, payload = codec.decode_partial(message)
         self.partial_recv += payload
         if len(self.partial_recv) > self.config['max_message_length']:
             log.error("Received message longer than max length")
@@ -46,6 +48,16 @@ class AnomosNeighborProtocol(AnomosProtocol):
         if len(payload) == p_remain:
             self.got_message(self.partial_recv)
             self.partial_recv = ''
+    def got_credit(self, message):
+        # Credit for a stream we've already ended, nothing to do
+        pass
+    def got_ping(self, message):
+        seq = codec.decode_seq(message)
+        self.send_immediately(codec.frame(LINK_STREAM_ID, codec.pong(seq)))
+    def got_pong(self, message):
+        self.pong_received(codec.decode_seq(message))
+    def send_ping(self, seq):
+        self.send_immediately(codec.frame(LINK_STREAM_ID, codec.ping(seq)))
     def got_tcode(self, message):
         tcreader = TCReader(self.manager.certificate)
         try:
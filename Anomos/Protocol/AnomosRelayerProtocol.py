@@ -15,8 +15,8 @@
 
 # Written by John Schanck
 
-from Anomos.Protocol import TCODE, CONFIRM, UNCHOKE, CHOKE, ENCRYPTED, BREAK, PARTIAL, ACKBREAK
-from Anomos.Protocol import AnomosProtocol, toint
+from Anomos.Protocol import TCODE, CONFIRM, UNCHOKE, CHOKE, ENCRYPTED, BREAK, PARTIAL, ACKBREAK, CREDIT
+from Anomos.Protocol import AnomosProtocol, codec
 from Anomos import bttime, log_on_call, LOG as log
 
 class AnomosRelayerProtocol(AnomosProtocol):
@@ -27,9 +27,10 @@ class AnomosRelayerProtocol(AnomosProtocol):
                             #UNCHOKE: self.got_unchoke,\
                             CONFIRM: self.got_confirm, \
                             BREAK: self.got_break,\
-                            ENCRYPTED: self.relay_message,\
+                            ENCRYPTED: self.got_encrypted,\
                             PARTIAL: self.got_partial,\
-                            ACKBREAK: self.got_ack_break})
+                            ACKBREAK: self.got_ack_break,\
+                            CREDIT: self.got_credit})
     def invalid_message(self, t):
         log.warning("Invalid message of type %02x on %s. Closing stream."% \
                     (ord(t), self.uniq_id()))
@@ -46,15 +47,32 @@ class AnomosRelayerProtocol(AnomosProtocol):
     def got_confirm(self):
         self.connection_completed()
         self.relay_message(CONFIRM)
+    def got_encrypted(self, message):
+        self.unacked += len(message)
+        self.relay_message(message)
+        self.grant_credit()
+    def got_credit(self, message):
+        self.neighbor.add_credit(self.stream_id, codec.decode_credit(message))
     def got_partial(self, message):
-        p_remain = toint(message[1:5])
-        self.partial_recv += message[5:]
-        if len(self.partial_recv) > self.neighbor.config['max_message_length']:
-            log.error("Received message longer than max length")
+        """ PARTIAL chunks are forwarded as soon as they arrive instead
+            of being reassembled, only the stream id they're framed with
+            changes. All we keep is how much of the message is left. """
+        p_remain, payload = codec.decode_partial(message)
+        if self.partial_left == 0:
+            if p_remain > self.neighbor.config['max_message_length']:
+                log.error("Received message longer than max length")
+                self.close()
+                return
+            self.partial_type = payload[:1]
+        elif p_remain != self.partial_left:
+            log.error("Out of sequence PARTIAL on %s" % self.uniq_id())
+            self.close()
             return
-        if len(message[5:]) == p_remain:
-            self.got_message(self.partial_recv)
-            self.partial_recv = ''
+        self.partial_left = p_remain - len(payload)
+        self.relay_message(message)
+        if self.partial_type == ENCRYPTED:
+            self.unacked += len(payload)
+            self.grant_credit()
 
     # Message sending calls #
     def send_break(self):
@@ -63,13 +81,17 @@ class AnomosRelayerProtocol(AnomosProtocol):
         self.sent_break = True
     def send_tracking_code(self, trackcode):
         log.info("Queuing tracking code")
-        self.neighbor.queue_message(self.stream_id, TCODE+trackcode)
+        self.neighbor.queue_message(self.stream_id, TCODE+trackcode, True)
         if self.next_upload is None:
             self.ratelimiter.queue(self)
     def send_relay_message(self, msg):
-        self.neighbor.queue_message(self.stream_id, msg)
+        # Relayed ENCRYPTED messages and PARTIAL chunks are opaque,
+        # only CONFIRM can be told apart as control
+        self.neighbor.queue_message(self.stream_id, msg, msg[0] == CONFIRM)
     def send_confirm(self):
         self.network_ctl_msg(CONFIRM)
+    def send_credit(self, numbytes):
+        self.network_ctl_msg(CREDIT, codec.uint32(numbytes))
     def send_ack_break(self):
         if self.sent_break:
             self.network_ctl_msg(ACKBREAK)
@@ -11,12 +11,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import struct
+
 from binascii import b2a_hex
 from Anomos import LOG as log
 
 NAME = "Anomos10"
 
 NAT_CHECK_ID = chr(255)
+# Stream ID reserved for messages about the neighbor link itself
+LINK_STREAM_ID = 0xFFFF
 
 #--Message Control Characters--#
 #--BitTorrent--#
@@ -36,10 +40,42 @@ ENCRYPTED = chr(0xB) # The data that follows is AES encrypted
 BREAK = chr(0xC)
 ACKBREAK = chr(0xD)
 PARTIAL = chr(0xE)
+CREDIT = chr(0xF) # bytes of ENCRYPTED messages the sender may send
+PING = chr(0x10) # sequence number, sent on LINK_STREAM_ID
+PONG = chr(0x11) # sequence number of the PING being answered
+#--Sent encrypted between EndPoints--#
+REBIND = chr(0x12) # infohash, mac
+REBIND_ACK = chr(0x13) # accepted, infohash, mac
+HAVES = chr(0x14) # several indices, sent instead of a burst of HAVEs
+HAVE_ALL = chr(0x15) # Single byte, sent by seeds instead of a BITFIELD
+HAVE_NONE = chr(0x16) # Single byte, sent instead of an empty BITFIELD
+REJECT = chr(0x17) # index, begin, length of a request that won't be served
+ALLOWED_FAST = chr(0x18) # index of a piece which may be requested while choked
+SLICE_SIZE = chr(0x19) # length of the largest request the sender serves
 
 _MCODES = ['CHOKE', 'UNCHOKE', 'INTERESTED', 'NOT_INTERESTED', 'HAVE',\
            'BITFIELD', 'REQUEST', 'PIECE', 'CANCEL', 'TCODE', 'CONFIRM',\
-           'ENCRYPTED', 'BREAK', 'PARTIAL']
+           'ENCRYPTED', 'BREAK', 'ACKBREAK', 'PARTIAL', 'CREDIT', 'PING',\
+           'PONG', 'REBIND', 'REBIND_ACK', 'HAVES', 'HAVE_ALL', 'HAVE_NONE',\
+           'REJECT', 'ALLOWED_FAST', 'SLICE_SIZE']
+
+# Protocol extensions are advertised as bit flags in the first reserved
+# byte of the connection header. An extension is only used on a
+# NeighborLink if both neighbors advertise it.
+EXT_CREDIT = 0x01 # Per-stream credit based flow control
+EXT_PING = 0x02 # Link liveness probes
+EXTENSIONS = EXT_CREDIT | EXT_PING
+
+# Extensions which the EndPoints at both ends of a circuit have to
+# support, rather than each pair of neighbors along it, are announced end
+# to end in a CANCEL for an impossible request (see codec.extensions),
+# which clients without them ignore. Until the other end has announced
+# an extension it must not be sent any of its messages.
+E2E_REBIND = 0x01 # Rebinding parked circuits to another torrent
+E2E_HAVES = 0x02 # HAVES
+E2E_FAST = 0x04 # HAVE_ALL, HAVE_NONE, REJECT and ALLOWED_FAST
+E2E_SLICE_SIZE = 0x08 # SLICE_SIZE
+E2E_EXTENSIONS = E2E_REBIND | E2E_HAVES | E2E_FAST | E2E_SLICE_SIZE
 
 def mcode_to_name(c):
     return _MCODES[c]
@@ -47,9 +83,10 @@ def mcode_to_name(c):
 def toint(s):
     return int(b2a_hex(s), 16)
 
-def tobinary(i):
-    return (chr(i >> 24) + chr((i >> 16) & 0xFF) +
-        chr((i >> 8) & 0xFF) + chr(i & 0xFF))
+tobinary = struct.Struct('!L').pack
+
+# Needs the message codes above
+from Anomos.Protocol import codec
 
 class AnomosProtocol(object):
     ## Common features of all AnomosProtocols (Neighbor, Relayer, EndPoint) ##
@@ -103,6 +140,4 @@ class AnomosProtocol(object):
             @param message: Message type appropriate payload
             @type type: char (strictly 1 byte)
             @type message: string"""
-        return tobinary(self.stream_id)[2:] + \
-               tobinary(len(type+message)) + \
-               type + message
+        return codec.frame_message(self.stream_id, type, message)
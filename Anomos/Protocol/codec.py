@@ -0,0 +1,238 @@
+# codec.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Framing and fixed-layout fields of every Anomos wire message, built on
+# precompiled struct.Structs. All integers are big-endian and unsigned.
+#
+#  Neighbor frame:  [2:StreamID][4:Length][Length:Message]
+#  Message:         [1:Type][Payload]
+#
+#  Payloads:
+#   CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, CONFIRM, BREAK, ACKBREAK,
+#   HAVE_ALL, HAVE_NONE:
+#                   (empty)
+#   HAVE, ALLOWED_FAST
+#                   [4:index]
+#   HAVES           [4:index]...
+#   BITFIELD        [bitfield]
+#   REQUEST, CANCEL, REJECT
+#                   [4:index][4:begin][4:length]
+#   CANCEL          [4:0][4:EXTENSIONS_BEGIN][4:end to end extension bits]
+#   PIECE           [4:index][4:begin][piece]
+#   TCODE           [tracking code]
+#   ENCRYPTED       [AES encrypted message]
+#   PARTIAL         [4:bytes remaining, including this chunk][chunk]
+#   CREDIT          [4:bytes of ENCRYPTED messages granted]
+#   SLICE_SIZE      [4:length]
+#   PING, PONG      [4:sequence number]
+#   REBIND          [20:infohash][20:mac]
+#   REBIND_ACK      [1:accepted][20:infohash][20:mac]
+#
+# Decoders skip length checks unless validation is turned on with
+# set_validation(True), in which case malformed messages raise CodecError.
+# This is meant for fuzzing and debugging; the normal receive path relies
+# on struct raising on short input.
+
+import struct
+
+from Anomos.Protocol import CHOKE, UNCHOKE, INTERESTED, NOT_INTERESTED, \
+                            HAVE, BITFIELD, REQUEST, PIECE, CANCEL, \
+                            TCODE, CONFIRM, ENCRYPTED, BREAK, ACKBREAK, \
+                            PARTIAL, CREDIT, PING, PONG, REBIND, REBIND_ACK, \
+                            HAVES, HAVE_ALL, HAVE_NONE, REJECT, ALLOWED_FAST, \
+                            SLICE_SIZE
+
+FRAME_HEADER = struct.Struct('!HL')
+FRAME_HEADER_LEN = FRAME_HEADER.size
+MAX_STREAM_ID = 0xFFFF
+
+_U32 = struct.Struct('!L')
+_TYPED_U32 = struct.Struct('!cL')
+_TYPED_U32X2 = struct.Struct('!cLL')
+_TYPED_U32X3 = struct.Struct('!cLLL')
+
+PARTIAL_HEADER_LEN = _TYPED_U32.size
+PIECE_HEADER_LEN = _TYPED_U32X2.size
+# Offset of the CANCEL which announces end to end extensions. No request
+# can start there, so clients which don't know about it ignore it.
+EXTENSIONS_BEGIN = 0xFFFFFFFF
+
+# Exact lengths (type byte included) of fixed length messages
+MESSAGE_LENGTHS = {CHOKE: 1, UNCHOKE: 1, INTERESTED: 1, NOT_INTERESTED: 1,
+                   CONFIRM: 1, BREAK: 1, ACKBREAK: 1, HAVE: 5,
+                   REQUEST: 13, CANCEL: 13, CREDIT: 5, PING: 5, PONG: 5,
+                   REBIND: 41, REBIND_ACK: 42, HAVE_ALL: 1, HAVE_NONE: 1,
+                   REJECT: 13, ALLOWED_FAST: 5, SLICE_SIZE: 5}
+# Minimum lengths of variable length messages
+MIN_MESSAGE_LENGTHS = {BITFIELD: 1, PIECE: PIECE_HEADER_LEN + 1, HAVES: 5,
+                       TCODE: 2, ENCRYPTED: 2,
+                       PARTIAL: PARTIAL_HEADER_LEN + 1}
+
+class CodecError(ValueError):
+    pass
+
+_validate = False
+
+def set_validation(flag):
+    """ Turn strict length checking of decoded messages on or off """
+    global _validate
+    _validate = bool(flag)
+
+def validate(message):
+    """ Raise CodecError unless message is a well formed Anomos message """
+    if not message:
+        raise CodecError("Empty message")
+    t = message[0]
+    if t in MESSAGE_LENGTHS:
+        if len(message) != MESSAGE_LENGTHS[t]:
+            raise CodecError("Bad length %d for message type %02x" %
+                             (len(message), ord(t)))
+    elif t in MIN_MESSAGE_LENGTHS:
+        if len(message) < MIN_MESSAGE_LENGTHS[t]:
+            raise CodecError("Short message of type %02x" % ord(t))
+        if t == PARTIAL:
+            remaining = _TYPED_U32.unpack_from(message)[1]
+            if len(message) - PARTIAL_HEADER_LEN > remaining:
+                raise CodecError("Partial chunk longer than remaining length")
+        elif t == HAVES and (len(message) - 1) % _U32.size:
+            raise CodecError("HAVES length is not a multiple of 4")
+    else:
+        raise CodecError("Unknown message type %02x" % ord(t))
+
+## Encoders ##
+
+def frame(stream_id, message):
+    """ [StreamID][Length][Message] """
+    return FRAME_HEADER.pack(stream_id, len(message)) + message
+
+def frame_message(stream_id, type, payload=""):
+    """ [StreamID][Length][Type][Payload] """
+    return FRAME_HEADER.pack(stream_id, len(payload) + 1) + type + payload
+
+def uint32(i):
+    return _U32.pack(i)
+
+def have(index):
+    return _TYPED_U32.pack(HAVE, index)
+
+def haves(indices):
+    return struct.pack('!c%dL' % len(indices), HAVES, *indices)
+
+def request(index, begin, length):
+    return _TYPED_U32X3.pack(REQUEST, index, begin, length)
+
+def cancel(index, begin, length):
+    return _TYPED_U32X3.pack(CANCEL, index, begin, length)
+
+def extensions(bits):
+    return cancel(0, EXTENSIONS_BEGIN, bits)
+
+def reject(index, begin, length):
+    return _TYPED_U32X3.pack(REJECT, index, begin, length)
+
+def allowed_fast(index):
+    return _TYPED_U32.pack(ALLOWED_FAST, index)
+
+def piece(index, begin, data):
+    return _TYPED_U32X2.pack(PIECE, index, begin) + data
+
+def partial_header(remaining):
+    return _TYPED_U32.pack(PARTIAL, remaining)
+
+def credit(numbytes):
+    return _TYPED_U32.pack(CREDIT, numbytes)
+
+def slice_size(length):
+    return _TYPED_U32.pack(SLICE_SIZE, length)
+
+def ping(seq):
+    return _TYPED_U32.pack(PING, seq)
+
+def pong(seq):
+    return _TYPED_U32.pack(PONG, seq)
+
+## Decoders ##
+# Each takes the full message, type byte included.
+
+def decode_frame_header(data, offset=0):
+    """ @return: (stream id, message length) """
+    return FRAME_HEADER.unpack_from(data, offset)
+
+def decode_have(message):
+    """ HAVE and ALLOWED_FAST """
+    if _validate:
+        validate(message)
+    return _TYPED_U32.unpack_from(message)[1]
+
+def decode_haves(message):
+    """ @return: list of indices """
+    if _validate:
+        validate(message)
+    n = (len(message) - 1) / _U32.size
+    return struct.unpack_from('!%dL' % n, message, 1)
+
+def decode_request(message):
+    """ REQUEST, CANCEL and REJECT
+        @return: (index, begin, length) """
+    if _validate:
+        validate(message)
+    return _TYPED_U32X3.unpack_from(message)[1:]
+
+def decode_piece(message):
+    """ @return: (index, begin, data) """
+    if _validate:
+        validate(message)
+    t, index, begin = _TYPED_U32X2.unpack_from(message)
+    return index, begin, message[PIECE_HEADER_LEN:]
+
+def decode_credit(message):
+    if _validate:
+        validate(message)
+    return _TYPED_U32.unpack_from(message)[1]
+
+def decode_slice_size(message):
+    if _validate:
+        validate(message)
+    return _TYPED_U32.unpack_from(message)[1]
+
+def rebind(infohash, mac):
+    return REBIND + infohash + mac
+
+def rebind_ack(accepted, infohash, mac):
+    return REBIND_ACK + chr(bool(accepted)) + infohash + mac
+
+def decode_rebind(message):
+    """ @return: (infohash, mac) """
+    if _validate:
+        validate(message)
+    return message[1:21], message[21:41]
+
+def decode_rebind_ack(message):
+    """ @return: (accepted, infohash, mac) """
+    if _validate:
+        validate(message)
+    return message[1] != '\x00', message[2:22], message[22:42]
+
+def decode_seq(message):
+    """ PING and PONG """
+    if _validate:
+        validate(message)
+    return _TYPED_U32.unpack_from(message)[1]
+
+def decode_partial(message):
+    """ @return: (bytes remaining including this chunk, chunk) """
+    if _validate:
+        validate(message)
+    return _TYPED_U32.unpack_from(message)[1], message[PARTIAL_HEADER_LEN:]
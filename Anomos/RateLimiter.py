@@ -11,104 +11,353 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# Written by Uoti Urpala
+# Originally written by Uoti Urpala
+
+# RateLimiter is a two level hierarchical token bucket. The root bucket
+# enforces max_upload_rate. Below it, every connection belongs to one of
+# the traffic classes RELAY (Relayers), UPLOAD (EndPoints) and CONTROL
+# (the messages NeighborLinks send ahead of stream data, which are never
+# held back but are paid for).
+#
+# Each class may be assured a rate of its own, which it can use even when
+# the root bucket is empty, and borrows from the root bucket beyond that.
+# Classes which borrow share the root in proportion to their weights, and
+# the connections queued in a class share its bandwidth in proportion to
+# their rate_weight, using deficit round robin. Connections are kept in
+# insertion ordered dicts, so queueing and removing one costs O(1).
+#
+# Without an upload limit, which is the default, connections skip all of
+# this and write directly whenever they're queued.
+#
+# DownloadLimiter does the same for received data, with token buckets per
+# neighbor connection and for all of them together.
+
+from collections import OrderedDict
 
 from Anomos import bttime
 
+RELAY, UPLOAD, CONTROL = range(3)
+
+# Options for the assured rate and weight of each class
+CLASS_OPTIONS = {RELAY: ('relay_upload_rate', 'relay_upload_weight'),
+                 UPLOAD: ('endpoint_upload_rate', 'endpoint_upload_weight'),
+                 CONTROL: ('control_upload_rate', None)}
+
+class _Bucket(object):
+    """ Token bucket. Tokens may go negative, in which case the bucket
+        is empty until the debt has been paid off. A rate of None is
+        unlimited, a rate of 0 never gives any tokens. """
+    __slots__ = ['rate', 'depth', 'tokens', 'lasttime']
+    def __init__(self):
+        self.set_rate(0, 0)
+
+    def set_rate(self, rate, depth):
+        self.rate = rate
+        self.depth = depth
+        self.tokens = 0
+        self.lasttime = bttime()
+
+    def refill(self, t):
+        if self.rate:
+            self.tokens = min(self.depth,
+                              self.tokens + (t - self.lasttime) * self.rate)
+        self.lasttime = t
+
+    def has_tokens(self):
+        return self.rate is None or (self.rate > 0 and self.tokens >= 0)
+
+    def consume(self, numbytes):
+        if self.rate is not None:
+            self.tokens -= numbytes
+
+    def wait_time(self):
+        """ @return: Seconds until this bucket has tokens, None if never """
+        if self.has_tokens():
+            return 0
+        if not self.rate:
+            return None
+        return -self.tokens / self.rate
+
+class _Class(object):
+    def __init__(self):
+        self.bucket = _Bucket()
+        self.weight = 1
+        self.queued = OrderedDict() # {conn : deficit}
+        self.sent = 0
+
 class RateLimiter(object):
 
     def __init__(self, schedule):
         self.schedule = schedule
-        self.tail = None
-        self.upload_rate = 1e10
-        self.unitsize = 1e10
-        self.offset_amount = 0
+        self.root = _Bucket()
+        self.root.set_rate(None, 0)
+        self.unitsize = 17000
+        self.classes = [_Class() for c in CLASS_OPTIONS]
+        self.active = OrderedDict() # Classes with queued connections
+        self.sending = False
+        self.wakeup = None # Scheduled try_send
+        self.bypass = True # No upload limit, see _send_now
 
     def set_parameters(self, rate, unitsize):
         if rate == 0:
-            rate = 1e10
+            rate = None
             unitsize = 17000
-        if unitsize > 17000:
-            # Since data is sent to peers in a round-robin fashion, max one
-            # full request at a time, setting this higher would send more data
-            # to peers that use request sizes larger than standard 16 KiB.
-            # 17000 instead of 16384 to allow room for metadata messages.
-            unitsize = 17000
-        self.upload_rate = rate * 1024
+        else:
+            rate *= 1024
         self.unitsize = unitsize
-        self.lasttime = bttime()
-        self.offset_amount = 0
+        self.root.set_rate(rate, unitsize)
+        self.bypass = rate is None
+        if self.bypass and self.active and not self.sending:
+            # Send whatever was still waiting for tokens
+            if self.wakeup is not None:
+                self.wakeup.cancel()
+            self.try_send()
+        self._reschedule()
+
+    def set_class_parameters(self, config):
+        """ Read the assured rate (in kB/s) and weight of each class
+            from config """
+        for cls, (rate_opt, weight_opt) in CLASS_OPTIONS.iteritems():
+            c = self.classes[cls]
+            rate = config.get(rate_opt, 0) * 1024
+            c.bucket.set_rate(rate, max(self.unitsize, rate))
+            if weight_opt is not None:
+                c.weight = max(1, config.get(weight_opt, 1))
+        self._reschedule()
 
     def queue(self, conn):
         assert conn.next_upload is None
-        if self.tail is None:
-            # Queue is empty, add the connection and give it a chance
-            # to send its messages.
-            self.tail = conn
-            conn.next_upload = conn
-            self.try_send(True)
-        else:
-            # Queue is non-empty, add the connection to the tail of it
-            conn.next_upload = self.tail.next_upload
-            self.tail.next_upload = conn
-            self.tail = conn
+        if self.bypass:
+            self._send_now(conn)
+            return
+        c = self.classes[conn.rate_class]
+        conn.next_upload = c
+        c.queued[conn] = 0
+        if c not in self.active:
+            self.active[c] = None
+        if not self.sending and self.wakeup is None:
+            # Nothing else waiting, give it a chance to send right away
+            self.try_send()
+
+    def _send_now(self, conn):
+        """ Without an upload limit there's nothing to schedule, conn
+            writes for as long as its socket takes the data. It is
+            queued again by its socket_flushed once the socket drains. """
+        c = self.classes[conn.rate_class]
+        # Marks conn busy, so that a socket_flushed from inside
+        # send_partial doesn't queue it again and recurse
+        conn.next_upload = c
+        try:
+            while True:
+                try:
+                    sent = conn.send_partial(self.unitsize)
+                except KeyboardInterrupt:
+                    raise
+                except Exception, e:
+                    conn.got_exception(e)
+                    return
+                if not sent:
+                    return
+                c.sent += sent
+                if not conn.is_flushed():
+                    return
+        finally:
+            if conn.next_upload is c:
+                conn.next_upload = None
+
+    def remove(self, conn):
+        """ Stop serving conn, which has usually been closed """
+        c = conn.next_upload
+        if c is None:
+            return
+        conn.next_upload = None
+        c.queued.pop(conn, None)
+        if not c.queued:
+            self.active.pop(c, None)
 
-    def try_send(self, check_time=False):
+    def spent(self, cls, numbytes):
+        """ Charge numbytes sent outside of the limiter to class cls """
+        c = self.classes[cls]
+        if self.bypass:
+            c.sent += numbytes
+            return
         t = bttime()
-        self.offset_amount -= (t - self.lasttime) * self.upload_rate
-        self.lasttime = t
-        if check_time:
-            self.offset_amount = max(self.offset_amount, 0)
-        cur = self.tail.next_upload
-        while self.offset_amount <= 0:
+        c.bucket.refill(t)
+        self.root.refill(t)
+        if c.bucket.has_tokens():
+            c.bucket.consume(numbytes)
+        self.root.consume(numbytes)
+        c.sent += numbytes
+
+    def try_send(self):
+        self.wakeup = None
+        self.sending = True
+        t = bttime()
+        self.root.refill(t)
+        for c in self.classes:
+            c.bucket.refill(t)
+        try:
+            while self.active:
+                c = self._pick()
+                if c is None:
+                    break
+                self._serve(c)
+        finally:
+            self.sending = False
+        self._reschedule()
+
+    def _pick(self):
+        """ Next class to serve, preferring those with assured tokens,
+            then those that may borrow from the root """
+        chosen = None
+        for c in self.active:
+            if c.bucket.has_tokens():
+                chosen = c
+                break
+        if chosen is None:
+            if not self.root.has_tokens():
+                return None
+            chosen = self.active.iterkeys().next()
+        # Move to the back of the round robin
+        del self.active[chosen]
+        self.active[chosen] = None
+        return chosen
+
+    def _serve(self, c):
+        """ Give each connection of class c one deficit round robin turn,
+            up to c.weight quanta in total """
+        budget = self.unitsize * c.weight
+        while budget > 0 and c.queued:
+            conn, deficit = c.queued.popitem(last=False)
+            deficit += self.unitsize * conn.rate_weight
+            if deficit <= 0:
+                # Still paying off an earlier overshoot
+                c.queued[conn] = deficit
+                continue
             try:
-                bytes = cur.send_partial(self.unitsize)
+                sent = conn.send_partial(deficit)
             except KeyboardInterrupt:
                 raise
             except Exception, e:
-                cur.got_exception(e)
-                cur = self.tail.next_upload
-                bytes = 0
-
-            self.offset_amount += bytes
-            if bytes == 0 or not cur.is_flushed():
-                # Nothing was sent during the last send_partial
-                if self.tail is cur:
-                    # Cur was the only connection in the queue, so stop
-                    # trying to send messages.
-                    self.tail = None
-                    cur.next_upload = None
-                    break
-                else:
-                    # Dequeue cur
-                    self.tail.next_upload = cur.next_upload
-                    cur.next_upload = None
-                    cur = self.tail.next_upload
+                conn.got_exception(e)
+                sent = 0
+            if sent:
+                if c.bucket.has_tokens():
+                    c.bucket.consume(sent)
+                self.root.consume(sent)
+                c.sent += sent
+                budget -= sent
+            if sent == 0 or conn.next_upload is not c or not conn.is_flushed():
+                # Nothing more to send for now, or removed while sending
+                conn.next_upload = None
             else:
-                self.tail = cur
-                cur = cur.next_upload
-        else:
-            self.schedule(self.offset_amount / self.upload_rate, self.try_send)
+                # Only overshoot carries over to the next turn
+                c.queued[conn] = min(0, deficit - sent)
+            if not (self.root.has_tokens() or c.bucket.has_tokens()):
+                break
+        if not c.queued:
+            self.active.pop(c, None)
 
-    def clean_closed(self):
-        if self.tail is None:
+    def _reschedule(self):
+        if self.sending or not self.active:
             return
-        orig = self.tail
-        if self.tail.closed:
-            self.tail = Dummy(self.tail.next_upload)
-        c = self.tail
-        while True:
-            if c.next_upload is orig:
-                c.next_upload = self.tail
-                break
-            if c.next_upload.closed:
-                c.next_upload = Dummy(c.next_upload.next_upload)
-            c = c.next_upload
+        waits = [self.root.wait_time()]
+        waits.extend([c.bucket.wait_time() for c in self.active])
+        waits = [w for w in waits if w is not None]
+        if not waits:
+            return
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+        self.wakeup = self.schedule(min(waits), self.try_send)
 
-class Dummy(object):
-    def __init__(self, next):
-        self.next_upload = next
-    def send_partial(self, size):
-        return 0
-    closed = False
+    def get_stats(self):
+        return {'relayUploadTotal' : self.classes[RELAY].sent,
+                'endpointUploadTotal' : self.classes[UPLOAD].sent,
+                'controlUploadTotal' : self.classes[CONTROL].sent}
+
+class DownloadLimiter(object):
+    """ Paces reads from neighbor connections with a token bucket per
+        connection and a global one. A connection which has read more
+        than either bucket allows stops reading until the debt has been
+        paid off, so the sender is held back by TCP rather than by
+        buffering on our side. """
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.root = _Bucket()
+        self.root.set_rate(None, 0)
+        self.link_rate = None
+        self.links = {} # {P2PConnection : _Bucket}
+        self.paused = {} # {P2PConnection : scheduled resume}
+        self.received_total = 0
+
+    def set_parameters(self, rate, link_rate):
+        """ Rates are in kB/s, 0 means no limit """
+        self.root.set_rate(*self._rate_depth(rate))
+        self.link_rate = link_rate
+        for b in self.links.itervalues():
+            b.set_rate(*self._rate_depth(link_rate))
+        # Let the paused connections see the new rates
+        for conn, task in self.paused.items():
+            task.cancel()
+            self._resume(conn)
+
+    def _rate_depth(self, rate):
+        if not rate:
+            return None, 0
+        rate *= 1024
+        # Allow bursts of a quarter of a second
+        return rate, max(rate / 4, 2 ** 14)
+
+    def add(self, conn):
+        b = self.links[conn] = _Bucket()
+        b.set_rate(*self._rate_depth(self.link_rate))
+        conn.download_limiter = self
+
+    def remove(self, conn):
+        self.links.pop(conn, None)
+        task = self.paused.pop(conn, None)
+        if task is not None:
+            task.cancel()
+        conn.download_limiter = None
+
+    def received(self, conn, numbytes):
+        """ Called by conn after each read """
+        b = self.links.get(conn)
+        if b is None:
+            return
+        self.received_total += numbytes
+        t = bttime()
+        self.root.refill(t)
+        b.refill(t)
+        self.root.consume(numbytes)
+        b.consume(numbytes)
+        if conn not in self.paused:
+            wait = self._wait_time(b)
+            if wait > 0:
+                conn.pause_reading()
+                self._pause(conn, wait)
+
+    def _wait_time(self, b):
+        return max(self.root.wait_time(), b.wait_time())
+
+    def _pause(self, conn, wait):
+        self.paused[conn] = self.schedule(wait, lambda: self._resume(conn))
+
+    def _resume(self, conn):
+        del self.paused[conn]
+        b = self.links.get(conn)
+        if b is None:
+            return
+        t = bttime()
+        self.root.refill(t)
+        b.refill(t)
+        wait = self._wait_time(b)
+        if wait > 0:
+            # Other connections used up the global bucket meanwhile
+            self._pause(conn, wait)
+        else:
+            conn.resume_reading()
 
+    def get_stats(self):
+        return {'downloadReadsPaused' : len(self.paused),
+                'downloadReceived' : self.received_total}
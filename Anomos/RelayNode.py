@@ -0,0 +1,256 @@
+# RelayNode.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# A headless node which only relays, without any torrents or storage.
+#
+# Both halves of a relay have to live in the event loop which owns their
+# NeighborLinks, so relaying is spread over several cores by running a
+# number of RelayWorker processes, each of which joins the network as a
+# peer of its own with its own certificate, listening port and neighbors.
+#
+# The RelaySupervisor creates the identities, starts the workers and does
+# the tracker announces for all of them. Workers report their status to
+# the supervisor every SYNC_INTERVAL seconds over a multiprocessing Pipe,
+# and the supervisor forwards the neighbor lists it gets from the tracker
+# back to them. A worker which dies is restarted with the same identity.
+
+import asyncore
+import os
+import threading
+
+from multiprocessing import Process, Pipe, cpu_count
+
+from M2Crypto import Rand
+
+import Anomos.Crypto
+
+from Anomos.EventHandler import EventHandler
+from Anomos.NeighborManager import NeighborManager
+from Anomos.RateLimiter import RateLimiter, DownloadLimiter, CLASS_OPTIONS
+from Anomos.Rerequester import Rerequester
+from Anomos.SingleportListener import SingleportListener
+from Anomos import BTFailure, LOG as log
+
+SYNC_INTERVAL = 1.0 # Seconds between worker status reports
+
+class RelayWorker(object):
+    """ Runs a NeighborManager without any torrents in a process of
+        its own. """
+    def __init__(self, config, certificate, sessionid, conn):
+        self.config = config
+        self.certificate = certificate
+        self.sessionid = sessionid
+        self.conn = conn
+        self.manager = None
+
+    def run(self):
+        # Forget the parent's sockets and random state
+        asyncore.socket_map.clear()
+        Rand.rand_seed(os.urandom(32))
+        self.doneflag = threading.Event()
+        self.event_handler = EventHandler(self.doneflag,
+                                          poller=self.config['poller'])
+        self.schedule = self.event_handler.schedule
+        ratelimiter = RateLimiter(self.schedule)
+        ratelimiter.set_parameters(self.config['max_upload_rate'],
+                                   self.config['upload_unit_size'])
+        ratelimiter.set_class_parameters(self.config)
+        downloadlimiter = DownloadLimiter(self.schedule)
+        downloadlimiter.set_parameters(self.config['max_download_rate'],
+                                       self.config['max_link_download_rate'])
+        ssl_ctx = self.certificate.get_ctx(allow_unknown_ca=True)
+        listener = SingleportListener(self.config, ssl_ctx)
+        try:
+            listener.find_port(False)
+        except BTFailure, e:
+            self.conn.send(('error', str(e)))
+            return
+        self.manager = NeighborManager(self.config, self.certificate,
+                            ssl_ctx, self.sessionid, self.schedule,
+                            ratelimiter, downloadlimiter)
+        self.conn.send(('port', listener.get_port(self.manager)))
+        self.schedule(0, self._sync)
+        self.event_handler.loop()
+        listener.close_sockets()
+
+    def _sync(self):
+        try:
+            while self.conn.poll():
+                self._got_command(*self.conn.recv())
+            self.conn.send(('status', self.get_status()))
+        except (EOFError, IOError):
+            # Supervisor went away
+            self.doneflag.set()
+            return
+        self.schedule(SYNC_INTERVAL, self._sync)
+
+    def _got_command(self, cmd, arg=None):
+        if cmd == 'neighbors':
+            self.manager.update_neighbor_list(arg)
+        elif cmd == 'failids':
+            self.manager.remove_reported_failids(arg)
+        elif cmd == 'stop':
+            self.doneflag.set()
+
+    def get_status(self):
+        status = {'count' : self.manager.count(),
+                  'relayed' : self.manager.relayed(),
+                  'failed' : self.manager.failed_connections()}
+        status.update(self.manager.get_relay_stats())
+        return status
+
+def _run_worker(config, certificate, sessionid, conn):
+    RelayWorker(config, certificate, sessionid, conn).run()
+
+class _WorkerNeighbors(object):
+    """ Stands in for a worker's NeighborManager in the supervisor's
+        Rerequester, using the last status the worker reported """
+    def __init__(self, num, certificate, sessionid):
+        self.num = num
+        self.certificate = certificate
+        self.sessionid = sessionid
+        self.process = None
+        self.conn = None
+        self.port = None
+        self.rerequester = None
+        self.failed = False # Couldn't be started
+        self.status = {}
+
+    def send(self, cmd, arg=None):
+        if self.conn is not None:
+            try:
+                self.conn.send((cmd, arg))
+            except (EOFError, IOError):
+                pass
+
+    # Called by Rerequester #
+    def count(self):
+        return self.status.get('count', 0)
+
+    def relayed(self):
+        return self.status.get('relayed', 0)
+
+    def failed_connections(self):
+        return self.status.get('failed', [])
+
+    def remove_reported_failids(self, failids):
+        self.send('failids', failids)
+
+    def update_neighbor_list(self, peers):
+        self.send('neighbors', peers)
+
+    def start_circuit(self, tc, infohash, aeskey):
+        # Relay only announces never get tracking codes
+        pass
+
+class RelaySupervisor(object):
+    def __init__(self, config, output):
+        self.config = config
+        self.output = output
+        self.doneflag = threading.Event()
+        num = config['relay_workers'] or cpu_count()
+        Anomos.Crypto.init(config['data_dir'])
+        self.workers = []
+        for i in xrange(num):
+            if i == 0 and config['identity'] not in ['', None]:
+                cert = Anomos.Crypto.Certificate(loc=config['identity'],
+                                                 ephemeral=False)
+            else:
+                cert = Anomos.Crypto.Certificate(ephemeral=True)
+            self.workers.append(_WorkerNeighbors(i, cert,
+                                                 Anomos.Crypto.get_rand(8)))
+        # Workers get an equal share of each upload rate
+        self.worker_config = dict(config)
+        for opt in ['max_upload_rate', 'max_download_rate'] + \
+                [rate for rate, weight in CLASS_OPTIONS.values()]:
+            self.worker_config[opt] = float(config[opt]) / num
+        for w in self.workers:
+            self._start_worker(w)
+        # Workers are forked before the supervisor has an event loop
+        # so that they don't inherit it
+        self.event_handler = EventHandler(self.doneflag,
+                                          poller=config['poller'])
+        self.schedule = self.event_handler.schedule
+
+    def run(self):
+        self.schedule(0, self._sync)
+        self.schedule(0, self.stats)
+        self.event_handler.loop()
+        self.shutdown()
+
+    def _start_worker(self, w):
+        w.conn, child = Pipe()
+        w.process = Process(target=_run_worker,
+                            args=(self.worker_config, w.certificate,
+                                  w.sessionid, child))
+        w.process.daemon = True
+        w.process.start()
+        w.status = {}
+
+    def _sync(self):
+        for w in self.workers:
+            if w.failed:
+                continue
+            try:
+                while w.conn.poll():
+                    self._got_report(w, *w.conn.recv())
+            except (EOFError, IOError):
+                pass
+            if not (w.failed or w.process.is_alive()):
+                log.warning("Relay worker %d exited, restarting it" % w.num)
+                self._start_worker(w)
+        self.schedule(SYNC_INTERVAL, self._sync)
+
+    def _got_report(self, w, kind, value):
+        if kind == 'status':
+            w.status = value
+        elif kind == 'port':
+            if w.rerequester is None:
+                w.port = value
+                w.rerequester = Rerequester(self.config['tracker'],
+                        self.config, self.schedule, w, lambda: 0,
+                        lambda: 0, lambda: 0, value, None, self.doneflag,
+                        self.doneflag.set, self._announce_done,
+                        w.certificate, w.sessionid)
+                w.rerequester.begin()
+            elif value != w.port:
+                w.port = value
+                w.rerequester.change_port(value)
+        elif kind == 'error':
+            log.critical("Relay worker %d failed: %s" % (w.num, value))
+            w.failed = True
+            if not [x for x in self.workers if not x.failed]:
+                self.doneflag.set()
+
+    def _announce_done(self):
+        pass
+
+    def get_status(self):
+        """ @return: The status reported by each worker """
+        return [dict(w.status, port=w.port) for w in self.workers]
+
+    def stats(self):
+        self.output.display(self.get_status())
+        self.schedule(self.config['display_interval'], self.stats)
+
+    def shutdown(self):
+        for w in self.workers:
+            if w.rerequester is not None:
+                w.rerequester.announce_stop()
+            w.send('stop')
+        for w in self.workers:
+            w.process.join(5)
+            if w.process.is_alive():
+                w.process.terminate()
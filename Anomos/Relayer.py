@@ -17,6 +17,7 @@
 
 from Anomos.Protocol.AnomosRelayerProtocol import AnomosRelayerProtocol
 from Anomos.Measure import Measure
+from Anomos.RateLimiter import RELAY
 from Anomos import LOG as log
 
 class Relayer(AnomosRelayerProtocol):
@@ -25,10 +26,13 @@ class Relayer(AnomosRelayerProtocol):
         association between the incoming socket and the outgoing socket (so
         that the TC only needs to be sent once).
     """
+    rate_class = RELAY
+    rate_weight = 1
     def __init__(self, stream_id, neighbor, outnid, data=None, orelay=None):
                     #storage, uprate, downrate, choker, key):
         AnomosRelayerProtocol.__init__(self)
-        self.partial_recv = ''
+        self.partial_left = 0 # Bytes of the PARTIAL message being relayed
+        self.partial_type = None # ..and the type of that message
         self.recvd_break = False
         self.sent_break = False
 
@@ -42,6 +46,10 @@ class Relayer(AnomosRelayerProtocol):
         self.complete = False
         self.closed = False
         self.next_upload = None
+        self.upstream_paused = None # NeighborLink we stopped reading from
+        self.throttled = False # Our outgoing queue is over its limit
+        self.credit_window = neighbor.credit_window()
+        self.unacked = 0 # ENCRYPTED bytes received but not yet re-granted
         self.decremented_count = False # Hack to prevent double decrementing of relay count
         self.orelay = orelay
         # Make the other relayer which we'll send data through
@@ -59,6 +67,8 @@ class Relayer(AnomosRelayerProtocol):
     def _complete_relay_message(self, msg):
         if not (self.orelay.closed or self.orelay.sent_break):
             self.orelay.send_relay_message(msg)
+            if self.orelay.throttled:
+                self.orelay.check_link_backlog()
 
     def relay_message(self, msg):
         if self.complete:
@@ -72,6 +82,9 @@ class Relayer(AnomosRelayerProtocol):
             return 0
         b = self.neighbor.send_partial(self.stream_id, bytes)
         self.measurer.update_rate(b)
+        if b and self.orelay is not None:
+            # Room may have opened up for more data from upstream
+            self.orelay.grant_credit()
         return b
 
     def connection_completed(self):
@@ -80,11 +93,63 @@ class Relayer(AnomosRelayerProtocol):
         self.flush_pre_buffer()
         self.orelay.complete = True
         self.orelay.flush_pre_buffer()
+        self.send_initial_credit()
+        self.orelay.send_initial_credit()
+
+    def send_initial_credit(self):
+        if self.credit_window:
+            self.send_credit(self.credit_window)
+
+    def grant_credit(self):
+        """ Return credit for the data we've relayed to our upstream
+            neighbor, unless the other half of this relay still has a
+            window's worth of it queued. This is what carries
+            backpressure from one hop of the circuit to the next. """
+        if not self.credit_window or self.closed or self.neighbor is None:
+            return
+        if self.unacked < self.credit_window / 2:
+            return
+        if self.orelay is not None and (self.orelay.throttled or
+                (self.orelay.neighbor is not None and
+                 self.orelay.neighbor.queued_bytes(self.orelay.stream_id)
+                    >= self.credit_window)):
+            return
+        self.send_credit(self.unacked)
+        self.unacked = 0
 
     def completion_timeout(self):
         if not self.complete:
             self.close()
 
+    def queue_full(self):
+        """ Our outgoing queue is full. The other half of this relay
+            stops granting CREDIT upstream until it drains, which holds
+            back only this circuit. """
+        self.throttled = True
+        self.check_link_backlog()
+
+    def check_link_backlog(self):
+        """ Stop reading from the neighbor the other half of this
+            relay receives from, which stalls every circuit it carries,
+            only once the link we send on has more than max_link_queue
+            bytes queued. Upstream neighbors without credit based flow
+            control can't be slowed down any other way. """
+        if self.upstream_paused is not None or self.orelay is None \
+                or self.orelay.neighbor is None or self.neighbor is None:
+            return
+        limit = self.neighbor.config['max_link_queue'] # 0 is no limit
+        if limit and self.neighbor.queued_total() > limit:
+            self.upstream_paused = self.orelay.neighbor
+            self.upstream_paused.pause_reading()
+
+    def queue_drained(self):
+        self.throttled = False
+        if self.upstream_paused is not None:
+            self.upstream_paused.resume_reading()
+            self.upstream_paused = None
+        if self.orelay is not None and not self.closed:
+            self.orelay.grant_credit()
+
     def socket_flushed(self):
         if self.should_queue():
             self.ratelimiter.queue(self)
@@ -108,6 +173,7 @@ class Relayer(AnomosRelayerProtocol):
             log.warning("Double close")
             return
         self.closed = True
+        self.queue_drained()
         if not (self.decremented_count or
                 (self.orelay and self.orelay.decremented_count)):
             self.manager.rm_relay(self)
@@ -115,7 +181,7 @@ class Relayer(AnomosRelayerProtocol):
         # Tell our orelay to close.
         if self.orelay and not self.orelay.closed:
             self.orelay.ore_closed()
-        self.ratelimiter.clean_closed()
+        self.ratelimiter.remove(self)
 
     def ore_closed(self):
         """ Closes the connection when a Break has been received by our
@@ -121,6 +121,9 @@ class Rerequester(object):
                 self.proxy_username, self.proxy_password = auth.split(':',1)
 
     def _makequery(self):
+        if self.infohash is None:
+            # Relay only, we're not sharing anything
+            return '?port=%s' % str(self.local_port)
         return ('?info_hash=%s&port=%s'%
                 (b64encode(self.infohash), str(self.local_port)))
 
@@ -14,8 +14,11 @@
 # Written by Bram Cohen, modified by Anomos Liberty Enhancements
 
 import os
+import sys
+import mmap
 from bisect import bisect_right
 from array import array
+from collections import OrderedDict
 
 from Anomos import BTFailure, LOG as log
 
@@ -28,6 +31,9 @@ class FilePool(object):
         self.handlebuffer = None
         self.handles = {}
         self.whandles = {}
+        # Memory mapped files hold a descriptor of their own, so they count
+        # against max_files_open too, least recently used first
+        self.maps = OrderedDict() # {filename : MmapStorage}
 
     def close_all(self):
         failures = {}
@@ -46,6 +52,7 @@ class FilePool(object):
     def set_max_files_open(self, max_files_open):
         self.max_files_open = max_files_open
         self.close_all()
+        self._trim_maps(max_files_open)
         if len(self.allfiles) > self.max_files_open:
             self.handlebuffer = []
         else:
@@ -69,6 +76,26 @@ class FilePool(object):
                len(self.allfiles) <= self.max_files_open:
             self.handlebuffer = None
 
+    def add_map(self, filename, storage):
+        """ Count a new mapping of filename, unmapping the least
+            recently used files to stay within max_files_open """
+        self.maps.pop(filename, None)
+        self._trim_maps(self.max_files_open - 1)
+        self.maps[filename] = storage
+
+    def used_map(self, filename):
+        storage = self.maps.pop(filename, None)
+        if storage is not None:
+            self.maps[filename] = storage
+
+    def remove_map(self, filename):
+        self.maps.pop(filename, None)
+
+    def _trim_maps(self, limit):
+        while self.maps and len(self.maps) + len(self.handles) > limit:
+            filename, storage = self.maps.popitem(last=False)
+            storage.unmap(filename)
+
 
 # Make this a separate function because having this code in Storage.__init__()
 # would make python print a SyntaxWarning (uses builtin 'file' before 'global')
@@ -172,23 +199,34 @@ class Storage(object):
     def read(self, pos, amount):
         r = []
         for filename, pos, end in self._intervals(pos, amount):
-            h = self._get_file_handle(filename, False)
-            h.seek(pos)
-            r.append(h.read(end - pos))
+            r.append(self._read(filename, pos, end))
         r = ''.join(r)
         if len(r) != amount:
             raise BTFailure('Short read - something truncated files?')
         return r
 
+    def read_buffer(self, pos, amount):
+        """ Like read, but may return a buffer, which is only good for
+            passing on to functions that accept one (like hashlib) """
+        return self.read(pos, amount)
+
+    def _read(self, filename, pos, end):
+        h = self._get_file_handle(filename, False)
+        h.seek(pos)
+        return h.read(end - pos)
+
     def write(self, pos, s):
         # might raise an IOError
         total = 0
         for filename, begin, end in self._intervals(pos, len(s)):
-            h = self._get_file_handle(filename, True)
-            h.seek(begin)
-            h.write(s[total: total + end - begin])
+            self._write(filename, begin, s[total: total + end - begin])
             total += end - begin
 
+    def _write(self, filename, pos, s):
+        h = self._get_file_handle(filename, True)
+        h.seek(pos)
+        h.write(s)
+
     def close(self):
         error = None
         for filename in self.handles.keys():
@@ -274,3 +312,143 @@ class Storage(object):
     def downloaded(self, pos, length):
         for filename, begin, end in self._intervals(pos, length):
             self.undownloaded[filename] -= end - begin
+
+
+# Mapping whole files needs more address space than 32 bit platforms have
+MMAP_SUPPORTED = sys.maxsize > 2 ** 32
+
+def _libc_fallocate():
+    """ posix_fallocate from the C library, os only has it from Python 3.3
+        @return: None if it isn't available """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        fallocate = libc.posix_fallocate
+    except (ImportError, EnvironmentError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    def posix_fallocate(fd, offset, length):
+        err = fallocate(fd, offset, length)
+        if err:
+            raise OSError(err, os.strerror(err))
+    return posix_fallocate
+
+posix_fallocate = getattr(os, 'posix_fallocate', None)
+if posix_fallocate is None and MMAP_SUPPORTED:
+    posix_fallocate = _libc_fallocate()
+
+class MmapStorage(Storage):
+    """ Storage which memory maps each file, so reads and writes are
+        copies to and from the page cache rather than system calls.
+        Files which can't be mapped use the FilePool like Storage. """
+
+    def __init__(self, config, filepool, files, check_only=False):
+        Storage.__init__(self, config, filepool, files, check_only)
+        self.lengths = dict([(f, end - begin)
+                             for begin, end, f in self.ranges])
+        self.maps = {} # {filename : mmap}
+        self.writable = {} # Files mapped for writing
+        self.unmapped = {} # Files which couldn't be mapped
+
+    def _get_map(self, filename, end, for_write):
+        """ @return: A mapping of filename which is at least end bytes
+                     long, None if there can't be one """
+        if filename in self.unmapped:
+            return None
+        m = self.maps.get(filename)
+        if m is not None and len(m) >= end and \
+                (filename in self.writable or not for_write):
+            self.filepool.used_map(filename)
+            return m
+        if not for_write and os.path.getsize(filename) < end:
+            # Not written that far yet, let the caller report it
+            return None
+        try:
+            if for_write:
+                m = self._map_for_write(filename)
+            else:
+                m = self._map_for_read(filename)
+        except (EnvironmentError, ValueError), e:
+            # Out of address space or disk space, an empty file,
+            # permissions...
+            log.warning("Can't memory map %s, using normal file "
+                        "access: %s" % (filename, e))
+            self.unmap(filename)
+            self.unmapped[filename] = None
+            return None
+        self.filepool.add_map(filename, self)
+        return m
+
+    def _map_for_read(self, filename):
+        self.unmap(filename)
+        h = file(filename, 'rb')
+        try:
+            m = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            h.close()
+        self.maps[filename] = m
+        return m
+
+    def _map_for_write(self, filename):
+        self.unmap(filename)
+        if posix_fallocate is None:
+            raise EnvironmentError("Can't reserve disk space for writing")
+        h = file(filename, 'rb+')
+        try:
+            # A mapping can't grow the file, so make it full length now.
+            # Writing to a page which has no disk space behind it kills
+            # the process, so reserve all of it as well, which fails
+            # like a normal write would if the disk is full.
+            posix_fallocate(h.fileno(), 0, self.lengths[filename])
+            m = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_WRITE)
+        finally:
+            h.close()
+        self.maps[filename] = m
+        self.writable[filename] = None
+        return m
+
+    def unmap(self, filename):
+        m = self.maps.pop(filename, None)
+        self.writable.pop(filename, None)
+        if m is not None:
+            self.filepool.remove_map(filename)
+            m.close()
+
+    def _read(self, filename, pos, end):
+        m = self._get_map(filename, end, False)
+        if m is None:
+            return Storage._read(self, filename, pos, end)
+        return m[pos:end]
+
+    def read_buffer(self, pos, amount):
+        intervals = self._intervals(pos, amount)
+        if len(intervals) == 1:
+            filename, pos, end = intervals[0]
+            m = self._get_map(filename, end, False)
+            if m is not None:
+                return buffer(m, pos, end - pos)
+        return self.read(pos, amount)
+
+    def _write(self, filename, pos, s):
+        m = self._get_map(filename, pos + len(s), True)
+        if m is None:
+            Storage._write(self, filename, pos, s)
+            return
+        m[pos:pos + len(s)] = s
+
+    def close(self):
+        error = None
+        for filename in self.maps.keys():
+            try:
+                if filename in self.writable:
+                    self.maps[filename].flush()
+                self.unmap(filename)
+            except EnvironmentError, e:
+                error = e
+        try:
+            Storage.close(self)
+        except Exception, e:
+            error = e
+        if error is not None:
+            raise error
@@ -36,9 +36,12 @@ FASTRESUME_PARTIAL = -3
 class StorageWrapper(object):
 
     def __init__(self, storage, config, hashes, piece_size, finished,
-            statusfunc, flag, data_flunked, infohash, resumefile):
+            statusfunc, flag, data_flunked, infohash, resumefile,
+            cache=None):
         self.numpieces = len(hashes)
         self.storage = storage
+        self.infohash = infohash
+        self.cache = cache # PieceCache shared with other torrents
         self.config = config
         check_hashes = config['check_hashes']
         self.hashes = hashes
@@ -299,21 +302,43 @@ class StorageWrapper(object):
     def do_I_have_requests(self, index):
         return not not self.inactive_requests[index]
 
-    def new_request(self, index):
-        # returns (begin, length)
+    def new_request(self, index, size=None):
+        """ Take the first size bytes (download_slice_size by default, a
+            multiple of it otherwise) which haven't been requested yet
+            from piece index. Requests may be joined from or split at
+            any multiple of download_slice_size.
+            @return: (begin, length) """
         if self.inactive_requests[index] == 1:
             self._make_inactive(index)
+        if size is None:
+            size = self.config['download_slice_size']
         self.numactive[index] += 1
         self.stat_active[index] = 1
         if index not in self.stat_dirty:
             self.stat_new[index] = 1
         rs = self.inactive_requests[index]
-        r = min(rs)
-        rs.remove(r)
-        self.amount_inactive -= r[1]
+        begin, length = min(rs)
+        rs.remove((begin, length))
+        if length > size:
+            rs.append((begin + size, length - size))
+            length = size
+        while length < size:
+            # Join the following part if that's free too
+            for r in rs:
+                if r[0] == begin + length:
+                    break
+            else:
+                break
+            rs.remove(r)
+            if length + r[1] > size:
+                rs.append((begin + size, length + r[1] - size))
+                length = size
+            else:
+                length += r[1]
+        self.amount_inactive -= length
         if self.amount_inactive == 0:
             self.endgame = True
-        return r
+        return begin, length
 
     def piece_came_in(self, index, begin, piece, source = None):
         if self.places[index] < 0:
@@ -335,7 +360,8 @@ class StorageWrapper(object):
             old = self.storage.read(self.places[index] * self.piece_size +
                                     begin, len(piece))
             if old != piece:
-                self.failed_pieces[index][self.download_history[index][begin]]\
+                # Parts may be requested at other offsets the second time
+                self.failed_pieces[index][self.download_history[index].get(begin)]\
                     = None
         self.download_history.setdefault(index, {})
         self.download_history[index][begin] = source
@@ -350,7 +376,7 @@ class StorageWrapper(object):
             del self.stat_new[index]
         if not self.inactive_requests[index] and not self.numactive[index]:
             del self.stat_dirty[index]
-            if hashlib.sha1(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() == self.hashes[index]:
+            if hashlib.sha1(self.storage.read_buffer(self.piece_size * self.places[index], self._piecelen(index))).digest() == self.hashes[index]:
                 self.have[index] = True
                 self.storage.downloaded(index * self.piece_size,
                                         self._piecelen(index))
@@ -399,10 +425,28 @@ class StorageWrapper(object):
     def get_piece(self, index, begin, length):
         if not self.have[index]:
             return None
+        if self.cache is not None and self.cache.fits(self._piecelen(index)):
+            return self._get_cached(index, begin, length)
         if not self.waschecked[index]:
-            if hashlib.sha1(self.storage.read(self.piece_size * self.places[index], self._piecelen(index))).digest() != self.hashes[index]:
+            if hashlib.sha1(self.storage.read_buffer(self.piece_size * self.places[index], self._piecelen(index))).digest() != self.hashes[index]:
                 raise BTFailure, 'told file complete on start-up, but piece failed hash check'
             self.waschecked[index] = True
         if begin + length > self._piecelen(index):
             return None
         return self.storage.read(self.piece_size * self.places[index] + begin, length)
+
+    def _get_cached(self, index, begin, length):
+        data = self.cache.get(self.infohash, index)
+        if data is None:
+            # Read ahead the whole piece, the rest of it is likely to
+            # be requested next
+            data = self.storage.read(self.piece_size * self.places[index],
+                                     self._piecelen(index))
+            if not self.waschecked[index]:
+                if hashlib.sha1(data).digest() != self.hashes[index]:
+                    raise BTFailure, 'told file complete on start-up, but piece failed hash check'
+                self.waschecked[index] = True
+            self.cache.put(self.infohash, index, data)
+        if begin + length > len(data):
+            return None
+        return data[begin:begin + length]
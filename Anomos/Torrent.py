@@ -56,7 +56,8 @@ class Torrent(object):
             self.active_streams.remove(endpoint)
 
     def close_all_streams(self):
-        for s in self.active_streams:
+        # Closing a stream removes it from active_streams
+        for s in self.active_streams[:]:
             if not s.closed:
                 s.close()
 
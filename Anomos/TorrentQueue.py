@@ -461,6 +461,14 @@ class TorrentQueue(Feedback):
             self.start_new_torrent(data)
         elif action == 'show_error':
             self.global_error("ERROR", data)
+        elif action in ('set_download_rate', 'set_link_download_rate'):
+            # data is the rate in kB/s, 0 for no limit
+            option = {'set_download_rate' : 'max_download_rate',
+                      'set_link_download_rate' : 'max_link_download_rate'}[action]
+            try:
+                self.set_config(option, int(data))
+            except ValueError:
+                self.global_error("ERROR", "Bad rate for %s: %s" % (action, data))
         elif action == 'no-op':
             pass
 
@@ -6,7 +6,17 @@ import twisted.web.http as http
 import twisted.protocols.policies as policies
 import M2Crypto.SSL.TwistedProtocolWrapper as wrapper
 
-from twisted.internet.selectreactor import SelectReactor, _NO_FILENO, _NO_FILEDESC
+from twisted.internet.selectreactor import SelectReactor
+from twisted.internet.error import ConnectionDone, ConnectionLost
+from twisted.python.failure import Failure
+try:
+    from twisted.internet.epollreactor import EPollReactor
+except ImportError:
+    EPollReactor = None
+try:
+    from twisted.internet.pollreactor import PollReactor
+except ImportError:
+    PollReactor = None
 
 from Anomos.parseargs import parseargs, formatDefinitions
 from Anomos.track import defaults, isotime, Tracker
@@ -64,19 +74,64 @@ class ServerCTXFactory(object):
         return self.ctx
 
 
-class SSLSelectReactor(SelectReactor):
-    def _doReadOrWrite(self, selectable, method, dict):
-        try:
-            why = getattr(selectable, method)()
-            handfn = getattr(selectable, 'fileno', None)
-            if not handfn:
-                why = _NO_FILENO
-            elif handfn() == -1:
-                why = _NO_FILEDESC
-        except:
-            why = sys.exc_info()[1]
+class SSLReactorMixin(object):
+    """ Works around M2Crypto's disconnect handling. When the reactor
+        disconnects a selectable (after a read/write error or a lost
+        descriptor) the TLS wrapper has to be told to lose its connection
+        as well, otherwise the wrapped protocol is never closed. Mixed into
+        whichever Twisted reactor the tracker is configured to use. """
+    def _disconnectSelectable(self, selectable, why, isRead, *args, **kwargs):
+        reason = why
+        if isinstance(why, Failure):
+            reason = why.value
+        # Ordinary disconnects aren't worth a line each
+        if not isinstance(reason, (ConnectionDone, ConnectionLost)):
             log.info(repr(why))
-        if why:
-            self._disconnectSelectable(selectable, why, method=="doRead")
-            selectable.loseConnection()
+        self._reactor_base._disconnectSelectable(self, selectable, why,
+                                                 isRead, *args, **kwargs)
+        selectable.loseConnection()
+
+class SSLSelectReactor(SSLReactorMixin, SelectReactor):
+    _reactor_base = SelectReactor
+
+REACTORS = {'select' : SSLSelectReactor}
+
+if PollReactor is not None:
+    class SSLPollReactor(SSLReactorMixin, PollReactor):
+        _reactor_base = PollReactor
+    REACTORS['poll'] = SSLPollReactor
 
+if EPollReactor is not None:
+    class SSLEPollReactor(SSLReactorMixin, EPollReactor):
+        _reactor_base = EPollReactor
+    REACTORS['epoll'] = SSLEPollReactor
+
+def make_reactor(name='auto'):
+    """ Return a new, not yet installed, SSL-aware reactor. 'auto' picks
+        epoll where available, then poll, then select. """
+    if name == 'auto':
+        for name in ('epoll', 'poll', 'select'):
+            if name in REACTORS:
+                break
+    elif name not in REACTORS:
+        log.warning("Reactor '%s' is not available, using select" % name)
+        name = 'select'
+    log.info("Using %s reactor" % name)
+    return REACTORS[name]()
+
+def raise_fd_limit():
+    """ Raise the soft limit on open files to the hard limit so that the
+        tracker can hold as many client connections as the system allows.
+        Returns the resulting limit, or None where unsupported. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, resource.error), e:
+            log.warning("Could not raise open file limit: %s" % e)
+    return soft
@@ -13,27 +13,71 @@
 
 # Written by Bram Cohen
 
+from random import sample
+
 from Anomos.Measure import Measure
+from Anomos.Protocol import E2E_FAST, E2E_SLICE_SIZE
+
+# Longest request peers which haven't announced E2E_SLICE_SIZE make
+LEGACY_SLICE_LENGTH = 2 ** 14
 
 
 class Upload(object):
 
     def __init__(self, stream, ratelimiter, totalup, choker,
-                 storage, max_slice_length, max_rate_period):
+                 storage, max_slice_length, max_rate_period,
+                 allowed_fast=(), allowed_fast_size=0):
         self.stream = stream
         self.ratelimiter = ratelimiter
         self.totalup = totalup
         self.choker = choker
         self.storage = storage
-        self.max_slice_length = max_slice_length
+        # Requests up to slice_length are served once we've told the other
+        # end about it with a SLICE_SIZE, until then only the old default
+        self.slice_length = max_slice_length
+        self.max_slice_length = min(max_slice_length, LEGACY_SLICE_LENGTH)
         self.max_rate_period = max_rate_period
         self.choked = True
         self.unchoke_time = None
         self.interested = False
         self.buffer = []
         self.measure = Measure(max_rate_period)
-        if storage.do_I_have_anything():
+        # Whether the other end announced E2E_FAST. A new circuit's other
+        # end announces its extensions after we've sent our bitfield,
+        # only rebound circuits know them up front.
+        self.fast = False
+        # Pieces this stream may request while choked. The list is shared
+        # by every stream of the torrent, so a peer can't get more free
+        # pieces by opening more circuits.
+        self.allowed_fast = allowed_fast
+        self.allowed_fast_size = allowed_fast_size
+        if stream.e2e_extensions & E2E_FAST:
+            if storage.get_amount_left() == 0:
+                stream.send_have_all()
+            elif storage.do_I_have_anything():
+                stream.send_bitfield(storage.get_have_list())
+            else:
+                stream.send_have_none()
+        elif storage.do_I_have_anything():
             stream.send_bitfield(storage.get_have_list())
+        self.extensions_announced()
+
+    def extensions_announced(self):
+        extensions = self.stream.e2e_extensions
+        if extensions & E2E_SLICE_SIZE and \
+                self.max_slice_length < self.slice_length:
+            self.max_slice_length = self.slice_length
+            self.stream.send_slice_size(self.slice_length)
+        if extensions & E2E_FAST and not self.fast:
+            self._start_fast()
+
+    def _start_fast(self):
+        self.fast = True
+        if len(self.allowed_fast) < self.allowed_fast_size:
+            fill_allowed_fast(self.allowed_fast, self.storage,
+                              self.allowed_fast_size)
+        for i in self.allowed_fast:
+            self.stream.send_allowed_fast(i)
 
     def got_not_interested(self):
         if self.interested:
@@ -62,11 +106,18 @@ class Upload(object):
         if not self.interested or length > self.max_slice_length:
             self.stream.close()
             return
-        if not self.stream.choke_sent:
-            self.buffer.append((index, begin, length))
-            if self.stream.next_upload is None and \
-                   self.stream.is_flushed():
+        if self.stream.choke_sent and \
+                not (self.fast and index in self.allowed_fast):
+            # Other peers expect requests made while choked to be dropped
+            if self.fast:
+                self.stream.send_reject(index, begin, length)
+            return
+        self.buffer.append((index, begin, length))
+        if self.stream.next_upload is None:
+            if self.stream.is_flushed():
                 self.ratelimiter.queue(self.stream)
+            else:
+                self.stream.wait_for_flush()
 
     def got_cancel(self, index, begin, length):
         try:
@@ -81,7 +132,18 @@ class Upload(object):
 
     def sent_choke(self):
         assert self.choked
-        del self.buffer[:]
+        if not self.fast:
+            # The other end drops its requests when it sees the CHOKE
+            del self.buffer[:]
+            return
+        # Tell the other end which requests it needs to make elsewhere
+        buffer = []
+        for index, begin, length in self.buffer:
+            if index in self.allowed_fast:
+                buffer.append((index, begin, length))
+            else:
+                self.stream.send_reject(index, begin, length)
+        self.buffer[:] = buffer
 
     def unchoke(self, time):
         if self.choked:
@@ -94,3 +156,11 @@ class Upload(object):
 
     def get_rate(self):
         return self.measure.get_rate()
+
+def fill_allowed_fast(allowed_fast, storage, size):
+    """ Add random pieces we have to the list allowed_fast until it
+        has size of them """
+    have = [i for i in xrange(storage.numpieces)
+                if storage.do_I_have(i) and i not in allowed_fast]
+    allowed_fast.extend(sample(have, min(len(have),
+                                         size - len(allowed_fast))))
@@ -76,3 +76,10 @@ class Bitfield:
             return r
         else:
             return self.bits.tostring()
+
+def full(length):
+    """ @return: A Bitfield with every bit set """
+    b = Bitfield(length)
+    b.bits = None
+    b.numfalse = 0
+    return b
@@ -35,6 +35,9 @@ common_options = [
         'whether to check hashes on disk'),
     ('max_upload_rate', 0,
         'maximum kB/s to upload at, 0 means no limit'),
+    ('max_download_rate', 0,
+        'maximum kB/s to receive at from all neighbors together, '
+        'relayed data included. 0 means no limit'),
     ('min_uploads', 2,
         "the number of uploads to fill out to with extra optimistic unchokes"),
     ('data_dir', '',
@@ -50,14 +53,24 @@ common_options = [
 rare_options = [
     ('download_slice_size', 2 ** 14,
         "how many bytes to query for per request."),
+    ('max_download_slice_size', 2 ** 17,
+        'how many bytes to query for per request from peers which accept '
+        'requests larger than download_slice_size. Rounded down to a '
+        'multiple of download_slice_size'),
+    ('max_request_backlog', 64,
+        'maximum number of requests to keep outstanding on one stream. Below '
+        'that, enough are sent to cover the round trip time of the circuit'),
     ('max_message_length', 2 ** 23,
         "maximum length prefix encoding you'll accept over the wire - larger values get the connection dropped."),
     ('socket_timeout', 300.0,
         'seconds to wait between closing sockets which nothing has been received on'),
     ('timeout_check_interval', 60.0,
         'seconds to wait between checking if any connections have timed out'),
-    ('max_slice_length', 16384,
+    ('max_slice_length', 2 ** 17,
         "maximum length slice to send to peers, close connection if a larger request is received"),
+    ('allowed_fast_set_size', 10,
+        'number of pieces a peer may request from us while choked, so that '
+        'new peers have something to share early on'),
     ('max_rate_period', 20.0,
         "maximum amount of time to guess the current rate estimate represents"),
     ('max_rate_period_seedtime', 100.0,
@@ -70,6 +83,61 @@ rare_options = [
         "number of downloads at which to switch from random to rarest first"),
     ('upload_unit_size', 1380,
         'how many bytes to write into network buffers at once.'),
+    ('max_link_download_rate', 0,
+        'maximum kB/s to receive at from any one neighbor, 0 means no limit'),
+    ('relay_upload_rate', 0,
+        'kB/s of the upload rate reserved for relaying, which is used even '
+        'when max_upload_rate has been reached'),
+    ('endpoint_upload_rate', 0,
+        'kB/s of the upload rate reserved for our own torrents'),
+    ('control_upload_rate', 0,
+        'kB/s of the upload rate reserved for control messages'),
+    ('relay_upload_weight', 1,
+        'share of the upload rate relaying gets beyond its reserved rate, '
+        'relative to endpoint_upload_weight'),
+    ('endpoint_upload_weight', 1,
+        'share of the upload rate our own torrents get beyond their reserved '
+        'rate, relative to relay_upload_weight'),
+    ('max_stream_queue', 2 ** 18,
+        'bytes which may be queued for sending on a single stream before its '
+        'producer is paused, 0 means no limit'),
+    ('max_link_queue', 2 ** 22,
+        'bytes which may be queued for sending to a single neighbor before the '
+        'producers of its streams are paused, 0 means no limit'),
+    ('max_control_queue', 2 ** 16,
+        'bytes of circuit control messages which may be queued to a neighbor '
+        'ahead of stream data'),
+    ('stream_credit_window', 2 ** 18,
+        'bytes a neighbor may send on one stream before waiting for us to '
+        'grant it more, on neighbors which support credit based flow control'),
+    ('ping_interval', 15.0,
+        'seconds between liveness probes sent to each neighbor, 0 disables them'),
+    ('ping_max_missed', 3,
+        'number of unanswered liveness probes after which a neighbor is '
+        'dropped and the circuits through it are closed'),
+    ('have_batch_interval', 0.1,
+        'seconds to collect completed pieces before announcing them to each '
+        'stream in one message, 0 sends them at the end of the current event '
+        'loop pass'),
+    ('circuit_pool_size', 2,
+        'number of idle circuits per neighbor to keep open for reuse when a '
+        'torrent is removed, 0 closes them'),
+    ('circuit_pool_timeout', 300,
+        'seconds to keep an idle circuit open waiting for a torrent to reuse it'),
+    ('max_rebind_refusals', 3,
+        'number of requests to rebind a circuit to a torrent we refuse before '
+        'closing it, so the other end can\'t probe for the torrents we have'),
+    ('failed_peer_ttl', 600,
+        'seconds to remember a neighbor we failed to connect to (and to keep '
+        'reporting it to the tracker) if the tracker never acknowledges it'),
+    ('max_concurrent_connects', 16,
+        'maximum number of outgoing neighbor connections to have in progress '
+        'at once, 0 means no limit'),
+    ('connect_timeout', 10.0,
+        'seconds to wait for an outgoing connection and its TLS handshake to complete'),
+    ('poller', 'auto',
+        'event loop backend to wait on sockets with (auto, epoll, poll or select). '
+        'auto uses epoll where available'),
     ('retaliate_to_garbled_data', 1,
      'refuse further connections from addresses with broken or intentionally '
      'hostile peers that send incorrect data'),
@@ -79,6 +147,13 @@ rare_options = [
      "character encoding used on the local filesystem. If left empty, autodetected. Autodetection doesn't work under python versions older than 2.3"),
     ('enable_bad_libc_workaround', 0,
      'enable workaround for a bug in BSD libc that makes file reads very slow.'),
+    ('piece_cache_size', 2 ** 25,
+     'bytes of recently uploaded pieces to keep in memory, shared by all '
+     'torrents, 0 disables the cache'),
+    ('mmap_storage', 0,
+     'access torrent files through memory mappings rather than reads and '
+     'writes. Only on 64 bit platforms, files which cannot be mapped are '
+     'read and written normally'),
     ('tracker_proxy', '',
         'address of HTTP proxy to use for tracker connections. Format: [username:password@]host:port'),
     ('anonymizer', 'https://tracker.anomos.info:5555/announce',
@@ -87,7 +162,8 @@ rare_options = [
 
 def get_defaults(ui):
     assert ui in "anondownloadheadless anondownloadcurses anondownloadgui " \
-           "anonlaunchmany anonlaunchmanycurses makeatorrentgui".split()
+           "anonlaunchmany anonlaunchmanycurses makeatorrentgui " \
+           "anonrelay".split()
 
     r = list(common_options)
 
@@ -153,6 +229,15 @@ def get_defaults(ui):
             ('spew', 0,
              "whether to display diagnostic info to stdout"))
 
+    if ui == 'anonrelay':
+        r.extend([
+            ('tracker', '',
+             'announce url of the tracker to relay for'),
+            ('relay_workers', 0,
+             'number of relay processes to run, each of which joins the '
+             'network as a separate peer. 0 means one per CPU'),
+            ])
+
     if ui == 'makeatorrentgui':
         r.extend([
             ('piece_size_pow2', 19,
@@ -30,11 +30,12 @@ from Anomos.DownloaderFeedback import DownloaderFeedback
 from Anomos.EndPoint import EndPoint
 from Anomos.NeighborManager import NeighborManager
 from Anomos.PiecePicker import PiecePicker
-from Anomos.RateLimiter import RateLimiter
+from Anomos.RateLimiter import RateLimiter, DownloadLimiter, CLASS_OPTIONS
 from Anomos.RateMeasure import RateMeasure
 from Anomos.Rerequester import Rerequester
 from Anomos.SingleportListener import SingleportListener
-from Anomos.Storage import Storage, FilePool
+from Anomos.Storage import Storage, MmapStorage, FilePool, MMAP_SUPPORTED
+from Anomos.PieceCache import PieceCache
 from Anomos.StorageWrapper import StorageWrapper
 from Anomos.Torrent import Torrent
 from Anomos.Uploader import Upload
@@ -47,6 +48,9 @@ from Anomos.EventHandler import EventHandler
 
 from M2Crypto.SSL import SSLError
 
+# Options which configure the RateLimiter's traffic classes
+CLASS_OPTION_NAMES = [o for opts in CLASS_OPTIONS.values() for o in opts if o]
+
 class Feedback(object):
 
     def finished(self, torrent):
@@ -71,12 +75,17 @@ class Multitorrent(object):
         self.config = dict(config)
         Anomos.Crypto.init(self.config['data_dir'])
         self.cert_flag = threading.Event()
-        self.event_handler = EventHandler(doneflag)
+        self.event_handler = EventHandler(doneflag, poller=config['poller'])
         self.schedule = self.event_handler.schedule
         self.filepool = FilePool(config['max_files_open'])
+        self.piececache = PieceCache(config['piece_cache_size'])
         self.ratelimiter = RateLimiter(self.schedule)
         self.ratelimiter.set_parameters(config['max_upload_rate'],
                                         config['upload_unit_size'])
+        self.ratelimiter.set_class_parameters(config)
+        self.downloadlimiter = DownloadLimiter(self.schedule)
+        self.downloadlimiter.set_parameters(config['max_download_rate'],
+                                            config['max_link_download_rate'])
         self.nbr_mngrs = {}
         self.torrents = {}
         set_filesystem_encoding(config['filesystem_encoding'])
@@ -138,7 +147,8 @@ class Multitorrent(object):
                     nbr = NeighborManager(self.config,
                             self.trackers[aurl][1], \
                             self.trackers[aurl][3], self.trackers[aurl][2], \
-                            self.schedule, self.ratelimiter)
+                            self.schedule, self.ratelimiter,
+                            self.downloadlimiter)
                     self.nbr_mngrs[aurl] = nbr
                     self.trackers[aurl][0] = nbr
             self.try_start_torrent(metainfo, config, feedback, filename, callback)
@@ -155,7 +165,7 @@ class Multitorrent(object):
         torrent = _SingleTorrent(self.event_handler, \
                                  self.trackers,\
                                  self.ratelimiter, self.filepool, config,\
-                                 )
+                                 self.piececache)
         self.event_handler.add_context(torrent)
         self.torrents[metainfo.infohash] = torrent
         def start():
@@ -196,7 +206,8 @@ class Multitorrent(object):
                         nbr = NeighborManager(self.config,
                                 self.trackers[aurl][1], \
                                 self.trackers[aurl][3], self.trackers[aurl][2], \
-                                self.schedule, self.ratelimiter)
+                                self.schedule, self.ratelimiter,
+                                self.downloadlimiter)
                         self.nbr_mngrs[aurl] = nbr
                         self.trackers[aurl][0] = nbr
         self.cert_flag.set()
@@ -205,17 +216,28 @@ class Multitorrent(object):
         if option not in self.config or self.config[option] == value:
             return
         if option not in 'max_upload_rate upload_unit_size '\
-               'max_files_open minport maxport'.split():
+               'max_download_rate max_link_download_rate '\
+               'max_files_open piece_cache_size minport maxport'.split() and \
+               option not in CLASS_OPTION_NAMES:
             return
         self.config[option] = value
+        if option in CLASS_OPTION_NAMES:
+            self.ratelimiter.set_class_parameters(self.config)
         if option == 'max_files_open':
             self.filepool.set_max_files_open(value)
+        elif option == 'piece_cache_size':
+            self.piececache.set_size(value)
         elif option == 'max_upload_rate':
             self.ratelimiter.set_parameters(value,
                                             self.config['upload_unit_size'])
+        elif option in ('max_download_rate', 'max_link_download_rate'):
+            self.downloadlimiter.set_parameters(
+                                        self.config['max_download_rate'],
+                                        self.config['max_link_download_rate'])
         elif option == 'upload_unit_size':
             self.ratelimiter.set_parameters(self.config['max_upload_rate'],
                                             value)
+            self.ratelimiter.set_class_parameters(self.config)
         elif option == 'maxport':
             for aurl, info in self.trackers.items():
                 port = info[4].port
@@ -263,10 +285,11 @@ class Multitorrent(object):
 class _SingleTorrent(object):
 
     def __init__(self, event_handler, trackers, ratelimiter, filepool,
-                 config):
+                 config, piececache=None):
         self.event_handler = event_handler
         self._ratelimiter = ratelimiter
         self._filepool = filepool
+        self._piececache = piececache
         self.config = dict(config)
         self._storage = None
         self._storagewrapper = None
@@ -330,8 +353,15 @@ class _SingleTorrent(object):
             myfiles = [save_path]
         self._filepool.add_files(myfiles, self)
         self._myfiles = myfiles
-        self._storage = Storage(self.config, self._filepool, zip(myfiles,
-                                                            metainfo.sizes))
+        storage_class = Storage
+        if self.config['mmap_storage']:
+            if MMAP_SUPPORTED:
+                storage_class = MmapStorage
+            else:
+                log.warning("Memory mapped storage needs a 64 bit "
+                            "platform, using normal file access")
+        self._storage = storage_class(self.config, self._filepool,
+                                      zip(myfiles, metainfo.sizes))
         resumefile = None
         if self.config['data_dir']:
             filename = os.path.join(self.config['data_dir'], 'resume',
@@ -362,7 +392,7 @@ class _SingleTorrent(object):
                 self._storagewrapper = StorageWrapper(self._storage,
                      self.config, metainfo.hashes, metainfo.piece_length,
                      self._finished, statusfunc, self._doneflag, data_flunked,
-                     self.infohash, resumefile)
+                     self.infohash, resumefile, self._piececache)
             except:
                 backthread_exception = sys.exc_info()
             self._contfunc()
@@ -399,10 +429,12 @@ class _SingleTorrent(object):
         downloader = Downloader(self.config, self._storagewrapper, picker,
                                 len(metainfo.hashes), downmeasure,
                                 self._ratemeasure.data_came_in, kickpeer)
+        allowed_fast = []
         def make_upload(connection):
             return Upload(connection, self._ratelimiter, upmeasure, choker,
                     self._storagewrapper, self.config['max_slice_length'],
-                    self.config['max_rate_period'])
+                    self.config['max_rate_period'], allowed_fast,
+                    self.config['allowed_fast_set_size'])
         self._torrent = Torrent(self.infohash, make_upload,
                                 downloader, len(metainfo.hashes), self)
         self.reported_port = self.config['forwarded_port'] # This is unlikely.
@@ -437,6 +469,16 @@ class _SingleTorrent(object):
             relay_stats = {'relayRate':0, 'relayCount':0, 'relaySent':0}
             for aurl, info in self.trackers.items():
                 relay_stats.update(info[0].get_relay_stats())
+                relay_stats.update(info[0].get_connect_stats())
+                relay_stats.update(info[0].get_flush_stats())
+                relay_stats.update(info[0].get_circuit_stats())
+                relay_stats.update(info[0].get_link_stats())
+            relay_stats.update(self._ratelimiter.get_stats())
+            if self._piececache is not None:
+                relay_stats.update(self._piececache.get_stats())
+            for aurl, info in self.trackers.items():
+                if info[0].downloadlimiter is not None:
+                    relay_stats.update(info[0].downloadlimiter.get_stats())
             return relay_stats
 
         self._statuscollecter = DownloaderFeedback(choker, upmeasure.get_rate,
@@ -570,6 +612,8 @@ class _SingleTorrent(object):
             self._hashcheck_thread.join() # should die soon after doneflag set
         if self._myfiles is not None:
             self._filepool.remove_files(self._myfiles)
+        if self._piececache is not None:
+            self._piececache.remove_torrent(self.infohash)
         if self._listening:
             for aurl, info in self.trackers.items():
                 try:
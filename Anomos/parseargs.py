@@ -31,6 +31,10 @@ def makeHelp(uiname, defaults):
         ret += "[OPTIONS] [TORRENTFILES]\n"
     elif uiname.startswith('anondownload'):
         ret += "[OPTIONS] [TORRENTFILE]\n"
+    elif uiname == 'anonrelay':
+        ret += "[OPTIONS] [TRACKER_URL]\n\n"
+        ret += "If a non-option argument is present it's taken as the value\n"\
+              "of the tracker option.\n"
     elif uiname == 'anonmaketorrent':
         ret += "[OPTION] TRACKER_URL FILE [FILE]\n"
     ret += '\n'
@@ -73,7 +73,9 @@ defaults = [
     ('max_give', 200, 'maximum number of peers to give with any one request'),
     ('data_dir', '', 'Directory in which to store cryptographic keys'),
     ('max_path_len', 6, 'Maximum number of hops in a circuit'),
-    ('allow_close_neighbors', 0, 'Allow multiple peers at the same IP address. (0 = disallow)')
+    ('allow_close_neighbors', 0, 'Allow multiple peers at the same IP address. (0 = disallow)'),
+    ('reactor', 'auto', 'Twisted reactor used by anontrack.py (auto, epoll, poll or select). auto uses epoll where available'),
+    ('raise_fd_limit', 1, 'raise the open file limit to the system maximum so more clients can connect at once (0 = leave it alone)')
     ]
 
 alas = 'your file may exist elsewhere in the universe\nbut alas, not here\n'
@@ -546,19 +548,22 @@ class Tracker(object):
 
         infohash = params('info_hash')
 
-        # Check if Tracker allows this torrent
-        notallowed = self.check_allowed(infohash)
-        if notallowed:
-            return notallowed
+        # Check if Tracker allows this torrent. Relay only peers
+        # announce without an infohash.
+        if infohash is not None:
+            notallowed = self.check_allowed(infohash)
+            if notallowed:
+                return notallowed
 
         data = {}
         if params('event') != 'stopped':
             data['peers'] = self.neighborlist(simpeer.name)
-            data['tracking codes'] = self.get_tcs(simpeer.name, infohash,
+            if infohash is not None:
+                data['tracking codes'] = self.get_tcs(simpeer.name, infohash,
                                                  self.config['response_size'])
             data['interval'] = self.reannounce_interval
 
-        if paramslist.has_key('scrape'):
+        if infohash is not None and paramslist.has_key('scrape'):
             data['scrape'] = self.scrapedata(infohash, False)
 
         return (200, 'OK', {'Content-Type': 'text/plain', 'Pragma':\
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Runs a relay only node, donating bandwidth to the network without
+# sharing any torrents.
+
+import sys
+
+from Anomos.RelayNode import RelaySupervisor
+from Anomos.defaultargs import get_defaults
+from Anomos.parseargs import printHelp
+from Anomos import configfile
+from Anomos import BTFailure
+
+class HeadlessDisplayer:
+    def display(self, workers):
+        print ''
+        for i, w in enumerate(workers):
+            print 'worker %d: port %s, %d neighbors, %d relays, ' \
+                  'relaying %.1f KB/s, %d KB relayed' % (i,
+                        w.get('port') or '-', w.get('count', 0),
+                        w.get('relayCount', 0),
+                        w.get('relayRate', 0) / (1 << 10),
+                        w.get('relaySent', 0) / (1 << 10))
+        return False
+
+
+if __name__ == '__main__':
+    uiname = 'anonrelay'
+    defaults = get_defaults(uiname)
+    try:
+        if len(sys.argv) < 2:
+            printHelp(uiname, defaults)
+            sys.exit(1)
+        config, args = configfile.parse_configuration_and_args(defaults,
+                                      uiname, sys.argv[1:], 0, 1)
+        if args:
+            config['tracker'] = args[0]
+        if not config['tracker']:
+            raise BTFailure("You must specify a tracker to relay for")
+    except BTFailure, e:
+        print 'error: ' + str(e) + '\nrun with no args for parameter explanations'
+        sys.exit(1)
+
+    RelaySupervisor(config, HeadlessDisplayer()).run()
@@ -42,10 +42,13 @@ def track(argv):
         return
 
     #Setup Twisted
-    # Install the SSLSelectReactor
-    del sys.modules['twisted.internet.reactor']
-    reactor = Anomos.TwistedServer.SSLSelectReactor()
+    # Install the SSL-aware reactor chosen in the config
+    if 'twisted.internet.reactor' in sys.modules:
+        del sys.modules['twisted.internet.reactor']
+    reactor = Anomos.TwistedServer.make_reactor(config['reactor'])
     installReactor(reactor)
+    if config['raise_fd_limit']:
+        log.info("Open file limit: %s" % Anomos.TwistedServer.raise_fd_limit())
     # Start logging
     twistlog.PythonLoggingObserver(loggerName='anomos').start()
 
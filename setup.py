@@ -27,7 +27,7 @@ if (os.name == 'nt'):
 
 scripts = ["anondownloadgui.py", "anondownloadcurses.py", "anondownloadheadless.py", 
            "makeatorrentgui.py", "makeatorrent.py",
-           "anonlaunchmany.py", "anonlaunchmanycurses.py", 
+           "anonlaunchmany.py", "anonlaunchmanycurses.py", "anonrelay.py",
            "anontrack.py", "anonreannounce.py", "anonrename.py", "showmetainfo.py"]
 
 img_root, doc_root = Anomos.calc_unix_dirs()